@@ -0,0 +1,282 @@
+"""Offline stand-ins for the upstream services, built from the cities in fixtures/cities.json.
+
+The cities are stored as geonames returns them (plus the name of their living
+wage metro area), and every other response is generated from them with the
+same structure and roughly the same size as the real pages:
+- api.geonames.org: getJSON and searchJSON;
+- www.areavibes.com: livability pages;
+- maps.googleapis.com: place search and photos;
+- livingwage.mit.edu: homepage, state locations and wages pages;
+- meteostat: the stations list and daily data, as local files for its endpoint.
+"""
+import gzip
+import hashlib
+import json
+import math
+import os.path
+import random
+import time
+from datetime import date, timedelta
+from urllib.parse import urlsplit, parse_qs
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+import utils
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "fixtures")
+
+# Approximate sizes of the real pages, the generated ones are padded to them.
+_AREAVIBES_PAGE_SIZE = 150 * 1024
+_LIVING_WAGE_PAGE_SIZE = 60 * 1024
+_PHOTO_SIZE = 80 * 1024
+
+
+def load_cities():
+    with open(os.path.join(FIXTURES_DIR, "cities.json")) as file_in:
+        return json.load(file_in)
+
+
+def _seed(*parts):
+    """Stable seed for the generated data of a page."""
+    return int(hashlib.sha256("|".join(map(str, parts)).encode()).hexdigest()[:8], 16)
+
+
+def _padding(size, seed):
+    """Markup to make a page about the given size, like the real pages' menus and scripts."""
+    rng = random.Random(seed)
+    words = ["city", "data", "home", "rent", "jobs", "school", "crime", "area", "map"]
+    items = []
+    while sum(map(len, items)) < size:
+        text = " ".join(rng.choice(words) for _ in range(8))
+        items.append(f'<li><a href="/{rng.randrange(10**6)}">{text}</a></li>\n')
+    return "<ul>\n" + "".join(items) + "</ul>\n"
+
+
+class FixtureAdapter(BaseAdapter):
+    """Answer the requests to the upstream services from the fixture cities.
+
+    Each response waits for the given latency (in seconds) first, to simulate the network.
+    """
+
+    def __init__(self, cities, latency=0.0):
+        super().__init__()
+        self._cities = {str(c["geonameId"]): c for c in cities}
+        self._latency = latency
+        self._areavibes_paths = {}
+        self._states = {}  # state name -> cities in it
+        for city in cities:
+            name, state = city["toponymName"], city["adminCodes1"]["ISO3166_2"]
+            # Areavibes only has the short name of cities like "New York City".
+            if name.endswith(" City"):
+                name = name[: -len(" City")]
+            path = f"/{utils.convert_to_citystate(f'{name}, {state}')}/livability"
+            self._areavibes_paths[path] = city
+            self._states.setdefault(utils.state_province_to_long(state), []).append(city)
+        # Wages page path -> name of the place.
+        self._places = {}
+        for i, state in enumerate(sorted(self._states)):
+            self._places[f"/states/{i:02d}"] = state
+            for city in self._states[state]:
+                self._places[f"/metros/{_seed(city['metro'])}"] = city["metro"]
+                if city["adminName2"]:
+                    self._places[f"/counties/{_seed(city['adminName2'])}"] = (
+                        f"{city['adminName2']}, {city['adminCodes1']['ISO3166_2']}"
+                    )
+
+    def send(self, request, **kwargs):
+        if self._latency:
+            time.sleep(self._latency)
+        url = urlsplit(request.url)
+        handlers = {
+            "api.geonames.org": self._geonames,
+            "www.areavibes.com": self._areavibes,
+            "maps.googleapis.com": self._google_places,
+            "livingwage.mit.edu": self._living_wage,
+        }
+        handler = handlers.get(url.hostname)
+        result = handler(url) if handler else None
+        status, content_type, body = result or (404, "text/html", b"Not Found")
+
+        response = requests.Response()
+        response.status_code = status
+        response.headers = CaseInsensitiveDict({"Content-Type": content_type})
+        response._content = body
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+    def _geonames(self, url):
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if url.path == "/getJSON":
+            city = self._cities.get(params.get("geonameId"))
+            if city is None:
+                return 200, "application/json", b'{"status": {"value": 15}}'
+            return 200, "application/json", json.dumps(city).encode()
+        if url.path == "/searchJSON":
+            name = params.get("q", "").split(",")[0].strip().lower()
+            results = [
+                city
+                for city in self._cities.values()
+                if name and city["toponymName"].lower().startswith(name)
+            ]
+            results = results[: int(params.get("maxRows", 100))]
+            body = {"totalResultsCount": len(results), "geonames": results}
+            return 200, "application/json", json.dumps(body).encode()
+        return None
+
+    def _areavibes(self, url):
+        city = self._areavibes_paths.get(url.path)
+        if city is None:
+            return None
+        rng = random.Random(_seed("areavibes", city["geonameId"]))
+        grades = ["A+", "A", "A-", "B+", "B", "B-", "C+", "C", "C-", "D", "F"]
+        scores = {
+            "Livability": f"{rng.randrange(50, 90)}",
+            "Cost of Living": rng.choice(grades),
+            "Crime": rng.choice(grades),
+            "Housing": rng.choice(grades),
+            "Schools": rng.choice(grades),
+        }
+        padding = _padding(_AREAVIBES_PAGE_SIZE // 2, _seed(url.path))
+        page = (
+            f"<html><head><title>{city['toponymName']} livability</title></head><body>\n"
+            + padding
+            + '<div class="summary-data">\n'
+            + "".join(
+                f'<div><em>{label}</em><i class="score">{score}</i></div>\n'
+                for label, score in scores.items()
+            )
+            + "</div>\n"
+            + padding
+            + "</body></html>"
+        )
+        return 200, "text/html; charset=utf-8", page.encode()
+
+    def _google_places(self, url):
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        if url.path.endswith("/findplacefromtext/json"):
+            reference = hashlib.sha1(params.get("input", "").encode()).hexdigest()
+            body = {
+                "candidates": [{"photos": [{"photo_reference": reference}]}],
+                "status": "OK",
+            }
+            return 200, "application/json", json.dumps(body).encode()
+        if url.path.endswith("/photo"):
+            rng = random.Random(_seed("photo", params.get("photoreference")))
+            return 200, "image/jpeg", rng.randbytes(_PHOTO_SIZE)
+        return None
+
+    def _living_wage(self, url):
+        path = url.path.rstrip("/")
+        if path == "":
+            links = "".join(
+                f'<li><a href="/states/{i:02d}/locations">{state}</a></li>\n'
+                for i, state in enumerate(sorted(self._states))
+            )
+            return 200, "text/html", self._living_wage_page("States", links)
+
+        parts = path.split("/")
+        states = sorted(self._states)
+        if len(parts) == 4 and parts[1] == "states" and parts[3] == "locations":
+            i = int(parts[2])
+            state, cities = states[i], self._states[states[i]]
+            metros = "".join(
+                f'<li><a href="/metros/{_seed(c["metro"])}">{c["metro"]}</a></li>\n'
+                for c in cities
+            )
+            counties = "".join(
+                f'<li><a href="/counties/{_seed(c["adminName2"])}">{c["adminName2"]}</a></li>\n'
+                for c in cities
+                if c["adminName2"]
+            )
+            content = (
+                f'<div class="metros list-unstyled"><ul>\n{metros}</ul></div>\n'
+                f'<div class="counties list-unstyled"><ul>\n{counties}</ul></div>\n'
+                f'<a href="/states/{i:02d}">Show results for {state} as a whole</a>\n'
+            )
+            return 200, "text/html", self._living_wage_page(state, content)
+
+        if path in self._places:
+            rng = random.Random(_seed(path))
+            wages = "".join(
+                f"<td>${rng.randrange(30, 150):,},{rng.randrange(1000):03d}</td>"
+                for _ in range(12)
+            )
+            content = (
+                '<div class="container">'
+                f"<h1>Living Wage Calculation for {self._places[path]}</h1></div>\n"
+                '<table class="expense_table"><tr class="results">'
+                f"<td>Required annual income before taxes</td>{wages}</tr></table>\n"
+            )
+            return 200, "text/html", self._living_wage_page(self._places[path], content)
+        return None
+
+    @staticmethod
+    def _living_wage_page(title, content):
+        padding = _padding(_LIVING_WAGE_PAGE_SIZE, _seed(title))
+        page = f"<html><head><title>{title}</title></head><body>\n{content}{padding}</body></html>"
+        return page.encode()
+
+
+def build_meteostat(directory, cities, years):
+    """Write a stations list with 4 stations around each city, and their daily data
+    for the given years, in the layout of the meteostat bulk endpoint."""
+    os.makedirs(os.path.join(directory, "stations"), exist_ok=True)
+    os.makedirs(os.path.join(directory, "daily", "full"), exist_ok=True)
+
+    stations = []
+    for city in cities:
+        lat, lng = float(city["lat"]), float(city["lng"])
+        for i in range(4):
+            station = f"B{city['geonameId'] % 10**6:06d}{i}"
+            stations.append(
+                f"{station},Bench {i},US,{city['adminCodes1']['ISO3166_2']},,,"
+                f"{lat + 0.02 * i:.5f},{lng - 0.02 * i:.5f},50,"
+                f"{city['timezone']['timeZoneId']},"
+                "2000-01-01,2030-12-31,2000-01-01,2030-12-31,2000-01-01,2030-12-31\n"
+            )
+            _write_daily(directory, station, lat, years)
+    with gzip.open(os.path.join(directory, "stations", "slim.csv.gz"), "wt") as file_out:
+        file_out.writelines(stations)
+
+
+def _write_daily(directory, station, lat, years):
+    rng = random.Random(_seed("meteostat", station))
+    # Warmer and less seasonal closer to the equator.
+    mean = 30 - abs(lat) / 2
+    amplitude = abs(lat) / 4
+    rows = []
+    day = date(min(years), 1, 1)
+    while day.year <= max(years):
+        season = math.sin((day.timetuple().tm_yday - 110) / 365 * 2 * math.pi)
+        tavg = mean + amplitude * season + rng.gauss(0, 2)
+        tmin = tavg - 4 - rng.random() * 4
+        tmax = tavg + 4 + rng.random() * 4
+        rows.append(f"{day},{tavg:.1f},{tmin:.1f},{tmax:.1f},0.0,,,,,1015.0,\n")
+        day += timedelta(days=1)
+    path = os.path.join(directory, "daily", "full", f"{station}.csv.gz")
+    with gzip.open(path, "wt") as file_out:
+        file_out.writelines(rows)
+
+
+def install(directory, cities, latency=0.0):
+    """Answer every upstream request from the fixtures; the meteostat files are written to directory."""
+    import http_client
+    from meteostat import Daily, Stations
+
+    adapter = FixtureAdapter(cities, latency=latency)
+    http_client._session.mount("http://", adapter)
+    http_client._session.mount("https://", adapter)
+
+    this_year = date.today().year
+    build_meteostat(directory, cities, years=(this_year - 2, this_year - 1))
+    endpoint = os.path.join(directory, "")
+    for cls in (Daily, Stations):
+        cls.endpoint = endpoint
+        # Read the files on every fetch, like a cold fetch downloads them.
+        cls.max_age = 0
+    return adapter
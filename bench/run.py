@@ -0,0 +1,280 @@
+"""Benchmark the fetch pipeline and the webapp offline, with the upstream services replaced by fixtures.
+
+    python bench/run.py [--out results.json] [--compare previous.json]
+
+Every upstream request is answered by bench/fixtures.py (optionally after a
+simulated --latency), the meteostat files are generated in a temporary
+directory and the app uses a temporary sqlite DB, so runs don't need network
+access or a MySQL server and can be compared with each other.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+_root_dir = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+_work_dir = tempfile.mkdtemp(prefix="cds-bench-")
+
+# Configure the app before importing it: no saved caches, no local search index
+# or living wages snapshot, a sqlite DB and no retries on upstream errors.
+os.environ.update(
+    {
+        "CDS_CACHE_DIR": "",
+        "CDS_GEONAMES_INDEX": os.path.join(_work_dir, "no_geonames_index.json"),
+        "CDS_LIVING_WAGES_SNAPSHOT": os.path.join(_work_dir, "no_snapshot.json"),
+        "CDS_DATABASE_URI": f"sqlite:///{os.path.join(_work_dir, 'bench.sqlite')}",
+        "CDS_HTTP_RETRIES": "0",
+        "CDS_GOOGLE_API_KEY": "bench",
+        "GEONAMES_USER": "bench",
+    }
+)
+sys.path.insert(0, os.path.join(_root_dir, "cds"))
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+import utils  # noqa: E402 (imported before city, which imports it back)
+import city  # noqa: E402
+import large_cities  # noqa: E402
+import living_wages  # noqa: E402
+import weather  # noqa: E402
+import fixtures  # noqa: E402
+
+
+def _clear_source_caches():
+    """Forget what previous fetches cached, so the next one is cold."""
+    weather._summaries.clear()
+    for cache in (
+        living_wages._state_paths,
+        living_wages._state_locations,
+        living_wages._wage_tables,
+    ):
+        cache.clear()
+
+
+def _time_each(function, args_list, repeat, *, before=None):
+    """Return the durations in seconds of calling function with each args, repeat times."""
+    durations = []
+    for _ in range(repeat):
+        for args in args_list:
+            if before:
+                before()
+            start = time.perf_counter()
+            function(*args)
+            durations.append(time.perf_counter() - start)
+    return durations
+
+
+def _summary(durations, elapsed=None):
+    """Latency percentiles in milliseconds, and the throughput if the total time is given."""
+    durations = sorted(durations)
+
+    def percentile(p):
+        return durations[round(p * (len(durations) - 1))] * 1000
+
+    summary = {
+        "n": len(durations),
+        "mean_ms": sum(durations) / len(durations) * 1000,
+        "min_ms": durations[0] * 1000,
+        "p50_ms": percentile(0.5),
+        "p95_ms": percentile(0.95),
+        "p99_ms": percentile(0.99),
+        "max_ms": durations[-1] * 1000,
+    }
+    if elapsed:
+        summary["per_second"] = len(durations) / elapsed
+    return summary
+
+
+def bench_pipeline(cities, repeat):
+    """Benchmark the functions used to fetch and serialize a city."""
+    ids = [str(c["geonameId"]) for c in cities]
+    results = {}
+
+    def fetch(geonameid, concurrent):
+        data = city.City(geonameid)
+        data.fetch_data(concurrent=concurrent)
+        return data
+
+    results["City.fetch_data"] = _time_each(
+        lambda i: fetch(i, True), [(i,) for i in ids], repeat, before=_clear_source_caches
+    )
+    results["City.fetch_data (sequential)"] = _time_each(
+        lambda i: fetch(i, False), [(i,) for i in ids], repeat, before=_clear_source_caches
+    )
+    fetched = [fetch(i, True) for i in ids]
+    results["City.fetch_data (cached sources)"] = _time_each(
+        lambda i: fetch(i, True), [(i,) for i in ids], repeat
+    )
+    results["city.search"] = _time_each(
+        lambda name: city.search(name, max_results=10),
+        [(f"{c['toponymName']}, {c['adminCodes1']['ISO3166_2']}",) for c in cities],
+        repeat,
+    )
+
+    coordinates = [(float(c["lat"]), float(c["lng"])) for c in cities]
+    results["large_cities.find_both_k_closest_and_radius"] = _time_each(
+        large_cities.find_both_k_closest_and_radius,
+        [(coords,) for coords in coordinates],
+        repeat * 100,
+    )
+
+    for data in fetched:
+        data.pop_image()
+        data.query = data.name
+    results["utils.create_output_xml"] = _time_each(
+        utils.create_output_xml,
+        [(data,) for data in fetched],
+        repeat * 100,
+        before=lambda: (utils._records.clear(), utils._xml_bodies.clear()),
+    )
+    results["utils.create_output_xml (memoized)"] = _time_each(
+        utils.create_output_xml, [(data,) for data in fetched], repeat * 100
+    )
+    results["City.to_json"] = _time_each(
+        city.City.to_json, [(data,) for data in fetched], repeat * 100
+    )
+    serialized = [data.to_json() for data in fetched]
+    results["City.from_json"] = _time_each(
+        city.City.from_json, [(s,) for s in serialized], repeat * 100
+    )
+    return {name: _summary(durations) for name, durations in results.items()}
+
+
+def bench_routes(cities, repeat, concurrency):
+    """Benchmark the webapp routes with concurrent clients."""
+    import app as cds_app
+
+    with cds_app.app.app_context():
+        cds_app.db.create_all()
+
+    queries = [f"{c['toponymName']},{c['adminCodes1']['ISO3166_2']}" for c in cities]
+    ids = [str(c["geonameId"]) for c in cities]
+    routes = {
+        "GET /api/single (cold)": [f"/api/single/{q}/" for q in queries],
+        "GET /api/single": [f"/api/single/{q}/" for q in queries],
+        "GET /api/single?format=json": [f"/api/single/{q}/?format=json" for q in queries],
+        "GET /api/multi": ["/api/multi/" + "&".join(queries) + "/"],
+        "GET /api/multi?format=csv": ["/api/multi/" + "&".join(queries) + "/?format=csv"],
+        "GET /web": [f"/web/{i}/" for i in ids],
+        "GET /api/suggest": [f"/api/suggest/{q[:n]}/" for q in queries for n in (1, 3)],
+    }
+
+    _clear_source_caches()
+    results = {}
+    for name, urls in routes.items():
+        # The first requests fetch the cities, the rest are served from the cache.
+        rounds = 1 if name.endswith("(cold)") else repeat * 20
+        durations, elapsed = _run_clients(cds_app.app, urls * rounds, concurrency)
+        results[name] = _summary(durations, elapsed)
+    return results
+
+
+def _run_clients(flask_app, urls, concurrency):
+    """Request all urls with concurrent clients; returns the durations and the total time."""
+    durations = []
+    lock = threading.Lock()
+    pending = list(reversed(urls))
+
+    def client():
+        test_client = flask_app.test_client()
+        while True:
+            with lock:
+                if not pending:
+                    return
+                url = pending.pop()
+            start = time.perf_counter()
+            response = test_client.get(url)
+            response.get_data()  # Consume streamed responses.
+            elapsed = time.perf_counter() - start
+            assert response.status_code == 200, f"{url}: {response.status_code}"
+            with lock:
+                durations.append(elapsed)
+
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return durations, time.perf_counter() - start
+
+
+def compare(results, previous):
+    """Print the p50 and p95 latencies of both runs side by side."""
+    print(f"\n{'benchmark':<48}{'p50 (ms)':>30}{'p95 (ms)':>30}")
+    for name, summary in results["results"].items():
+        before = previous["results"].get(name)
+        columns = []
+        for key in ("p50_ms", "p95_ms"):
+            if before is None:
+                columns.append(f"{summary[key]:.3f}")
+            else:
+                change = (summary[key] / before[key] - 1) * 100 if before[key] else 0
+                columns.append(f"{before[key]:.3f} -> {summary[key]:.3f} ({change:+.0f}%)")
+        print(f"{name:<48}{columns[0]:>30}{columns[1]:>30}")
+
+
+def _git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=_root_dir,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--out", help="json file to save the results")
+    parser.add_argument("--compare", help="results of a previous run to compare with")
+    parser.add_argument("--repeat", type=int, default=3, help="times to run each benchmark")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent clients")
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="simulated latency in seconds of each upstream request",
+    )
+    parser.add_argument(
+        "--skip-routes", action="store_true", help="only benchmark the fetch pipeline"
+    )
+    args = parser.parse_args()
+
+    cities = fixtures.load_cities()
+    fixtures.install(_work_dir, cities, latency=args.latency)
+
+    results = {
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "config": vars(args),
+        "results": bench_pipeline(cities, args.repeat),
+    }
+    if not args.skip_routes:
+        results["results"].update(bench_routes(cities, args.repeat, args.concurrency))
+
+    for name, summary in results["results"].items():
+        print(
+            f"{name:<48} p50 {summary['p50_ms']:9.3f}ms  p95 {summary['p95_ms']:9.3f}ms"
+            + (f"  {summary['per_second']:8.1f}/s" if "per_second" in summary else "")
+        )
+    if args.out:
+        with open(args.out, "w") as file_out:
+            json.dump(results, file_out, indent=2)
+    if args.compare:
+        with open(args.compare) as file_in:
+            compare(results, json.load(file_in))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,38 @@
 # app.py
 from os import getenv
-from flask import Flask, request, render_template, flash, redirect, url_for
-from utils import create_output_xml
+import click
+from flask import (
+    Flask,
+    request,
+    render_template,
+    flash,
+    redirect,
+    url_for,
+    abort,
+    jsonify,
+    session,
+    g,
+)
+from utils import create_output_xml, create_output_json, create_output_csv
+from cache import TTLCache
 from datetime import datetime, timedelta
-import xml.etree.ElementTree as ET
-from city import search as city_search, City
+from concurrent.futures import ThreadPoolExecutor
+from xml.sax.saxutils import quoteattr
+from city import search as city_search, City, CityNotFound
 from data_handler import DataHandler
+from refresher import RefreshQueue
+from warm_up import read_items, warm_up
+from write_behind import WriteBehind
+import http_client
+import large_cities
+import metrics
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import inspect
 from pymysql import install_as_MySQLdb
+import hashlib
+import math
+import time
+import requests
 
 install_as_MySQLdb()
 
@@ -22,29 +47,173 @@ db_config = {
     "passwd": getenv("DB_PASS", "pass"),
     "database": getenv("DB_NAME", "db"),
 }
-app.config[
-    "SQLALCHEMY_DATABASE_URI"
-] = "mysql://{user}:{passwd}@{host}:{port}/{database}".format(**db_config)
+# CDS_DATABASE_URI overrides them, e.g. to run the benchmarks with sqlite.
+app.config["SQLALCHEMY_DATABASE_URI"] = getenv(
+    "CDS_DATABASE_URI",
+    "mysql://{user}:{passwd}@{host}:{port}/{database}".format(**db_config),
+)
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+# Threads that get /api/multi cities concurrently, see _multi_executor.
+_MULTI_WORKERS = int(getenv("CDS_MULTI_WORKERS", "8"))
+if app.config["SQLALCHEMY_DATABASE_URI"].startswith("mysql"):
+    # A thread fetching a city holds a connection for its fetch lock and, to
+    # store it, briefly another one for its session (see DataHandler._fetch_lock).
+    # Allow two for each thread that can fetch at once (the request's, the
+    # /api/multi ones, the refresher's and the writer's), so they never wait on
+    # each other for a connection; only pool_size of them are kept open.
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_size": 5,
+        "max_overflow": 2 * (_MULTI_WORKERS + 3) - 5,
+    }
 db = SQLAlchemy(app)
 
 # Configure DB table to store data.
 class CachedCity(db.Model):
     geonameid = db.Column(db.String(100), primary_key=True)
     data = db.Column(db.JSON)
+    # Summary of the data, to list cities without decoding it.
+    timestamp = db.Column(db.DateTime, index=True)
+    name = db.Column(db.String(200))
+    full_name = db.Column(db.String(300))
+    population = db.Column(db.BigInteger)
 
     def __repr__(self):
         return f"<CachedCity {self.geonameid}>"
 
 
-# Pass the instantiated DB to our data handler.
-dh = DataHandler(db=db, table=CachedCity)
+# Configure DB table to store the city images, addressed by their sha256 digest.
+class CachedImage(db.Model):
+    digest = db.Column(db.String(64), primary_key=True)
+    content_type = db.Column(db.String(100))
+    data = db.Column(db.LargeBinary(length=2**24 - 1))
+
+    def __repr__(self):
+        return f"<CachedImage {self.digest}>"
+
 
 # Define the min/max wait time to refresh the data.
 # Data over this limit *can* be updated by user's request.
 min_data_refresh = timedelta(weeks=12)
 # Data over this limit *should* be updated due to its freshness.
 max_data_refresh = timedelta(weeks=52)
+# Data with sources that failed (N/A) is fetched again after this wait.
+incomplete_data_refresh = timedelta(minutes=30)
+
+# Configure DB table to store the city found for each (normalized) search query.
+class CachedQuery(db.Model):
+    query_key = db.Column(db.String(300), primary_key=True)
+    geonameid = db.Column(db.String(100), nullable=True)
+    timestamp = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return f"<CachedQuery {self.query_key}>"
+
+
+# Pass the instantiated DB to our data handler.
+# Decoded cities are kept in memory until they can be refreshed.
+dh = DataHandler(
+    db=db,
+    table=CachedCity,
+    image_table=CachedImage,
+    query_table=CachedQuery,
+    cache_ttl=min_data_refresh,
+    cache_size=int(getenv("CDS_CITY_CACHE_SIZE", "2000")),
+    cache_bytes=int(getenv("CDS_CITY_CACHE_MB", "64")) * 2**20,
+)
+
+# With CDS_WRITE_BEHIND=1, fetched cities are stored in batches by a background
+# thread, instead of committing each one while its request waits.
+if getenv("CDS_WRITE_BEHIND", "") == "1":
+    dh.set_writer(
+        WriteBehind(
+            app,
+            dh,
+            batch_size=int(getenv("CDS_WRITE_BATCH_SIZE", "50")),
+            max_delay=float(getenv("CDS_WRITE_DELAY", "1")),
+        )
+    )
+
+# Stale cities are served right away and refreshed in the background.
+refresher = RefreshQueue(
+    app,
+    dh,
+    older_than=min_data_refresh,
+    min_interval=float(getenv("CDS_REFRESH_INTERVAL", "10")),
+)
+
+# Pool to get the data of the cities in a /api/multi request concurrently.
+_multi_executor = ThreadPoolExecutor(
+    max_workers=_MULTI_WORKERS,
+    thread_name_prefix="api-multi",
+)
+
+_REQUEST_SECONDS = metrics.Histogram(
+    "cds_request_seconds",
+    "Time to answer each endpoint, until the response starts.",
+    ["endpoint"],
+)
+_RENDER_SECONDS = metrics.Histogram(
+    "cds_render_seconds", "Time to render each template.", ["template"], timing="render"
+)
+_SERIALIZE_SECONDS = metrics.Histogram(
+    "cds_serialize_seconds",
+    "Time to serialize a city for the API, by format.",
+    ["format"],
+    timing="serialize",
+)
+# Add a Server-Timing header with the time spent on each step to every response.
+_server_timing = getenv("CDS_SERVER_TIMING", "") == "1"
+
+# Rendered city pages by "geonameid@timestamp@show_refresh"; refreshing a city changes its timestamp.
+_pages = TTLCache(maxsize=1000, maxbytes=32 * 2**20, sizeof=len)
+metrics.register_cache("pages", _pages)
+
+
+@app.before_request
+def _start_request_timer():
+    g.request_start = time.perf_counter()
+    if _server_timing:
+        metrics.start_request_timings()
+
+
+@app.after_request
+def _stop_request_timer(response):
+    elapsed = time.perf_counter() - g.request_start
+    _REQUEST_SECONDS.observe(elapsed, request.endpoint or "unknown")
+    if _server_timing:
+        timings = metrics.pop_request_timings()
+        total = f"total;dur={elapsed * 1000:.1f}"
+        response.headers["Server-Timing"] = f"{timings}, {total}" if timings else total
+    return response
+
+
+def _render_template(template, **context):
+    with _RENDER_SECONDS.time(template):
+        return render_template(template, **context)
+
+
+# Seconds clients should wait after an upstream failure, when the upstream doesn't say.
+_UPSTREAM_RETRY_AFTER = 30
+
+
+@app.errorhandler(requests.RequestException)
+def upstream_failed(error):
+    """An upstream service needed for the request failed, or is skipped while it's failing."""
+    app.logger.warning(f"Upstream failure in {request.path}: {error}")
+    response = app.response_class(
+        "An external service is unavailable, try again later.\n",
+        status=503,
+        mimetype="text/plain",
+    )
+    retry_after = getattr(error, "retry_after", None) or _UPSTREAM_RETRY_AFTER
+    response.headers["Retry-After"] = str(math.ceil(retry_after))
+    return response
+
+
+@app.errorhandler(CityNotFound)
+def city_not_found(error):
+    return app.response_class(f"{error}\n", status=404, mimetype="text/plain")
+
 
 ##
 ## Webapp routes
@@ -61,12 +230,12 @@ def index():
             if action == "Search":
                 return redirect(url_for("search", query=query_value))
             elif action == "Go":
-                option_list = city_search(query_value, max_results=1)
-                if not option_list:
+                geonameid = dh.resolve_query(query_value)
+                if not geonameid:
                     flash(f'No cities found for "{query_value}"!')
                 else:
-                    return redirect(url_for("web", geonameid=option_list[0].geonameid))
-    return render_template("index.html", recent_cities=dh.get_recent_cities())
+                    return redirect(url_for("web", geonameid=geonameid))
+    return _render_template("index.html", recent_cities=dh.get_recent_cities())
 
 
 @app.route("/search/<query>", methods=("GET", "POST"))
@@ -80,19 +249,19 @@ def search(query):
         flash(f'No cities found for "{query}"!')
         return redirect(url_for("index"))
 
-    return render_template("options.html", option_list=options)
+    return _render_template("options.html", option_list=options)
 
 
 @app.route("/about/")
 def about():
     """Return the about page."""
-    return render_template("about.html")
+    return _render_template("about.html")
 
 
 @app.route("/api/info/")
 def api_info():
     """'Return the api-info page."""
-    return render_template("api.html")
+    return _render_template("api.html")
 
 
 @app.route("/api/example/")
@@ -110,13 +279,55 @@ def web(geonameid):
     diff = now - ts
     if diff >= max_data_refresh:
         # Data is too old, should refresh.
-        return redirect(url_for("refresh", geonameid=geonameid))
-    return render_template(
-        "city.html",
-        city=city,
-        geonameid=geonameid,
-        show_refresh=(diff >= min_data_refresh),
-    )
+        refresher.enqueue(geonameid)
+        flash("This data is outdated and it's being updated, check again in a bit!")
+    else:
+        _retry_failed_sources(geonameid, city)
+    show_refresh = min_data_refresh <= diff < max_data_refresh
+
+    # Pages with messages to show are always rendered.
+    if session.get("_flashes"):
+        return _render_template(
+            "city.html", city=city, geonameid=geonameid, show_refresh=show_refresh
+        )
+    key = f"{geonameid}@{city.timestamp}@{show_refresh}"
+    page = _pages.get(key)
+    if page is None:
+        page = _render_template(
+            "city.html", city=city, geonameid=geonameid, show_refresh=show_refresh
+        )
+        _pages.set(key, page)
+    response = app.response_class(page, mimetype="text/html")
+    # Browsers must check with us before reusing it, in case there are messages to show.
+    response.cache_control.no_cache = True
+    return _with_etag(response, page.encode())
+
+
+@app.route("/img/<digest>")
+def image(digest):
+    """Serve a city image; the content never changes for a given digest."""
+    img = dh.get_image(digest)
+    if img is None:
+        abort(404)
+    response = app.response_class(img.data, mimetype=img.content_type)
+    response.set_etag(digest)
+    response.cache_control.public = True
+    response.cache_control.max_age = 365 * 24 * 60 * 60
+    return response.make_conditional(request)
+
+
+def _retry_failed_sources(geonameid, city):
+    """Refresh a city in the background if some of its sources failed a while ago."""
+    if city.failed_sources:
+        diff = datetime.utcnow() - datetime.fromisoformat(city.timestamp)
+        if diff >= incomplete_data_refresh:
+            refresher.enqueue(geonameid)
+
+
+def _with_etag(response, body):
+    """Add a strong etag to the response and answer conditional requests for it."""
+    response.set_etag(hashlib.sha1(body).hexdigest())
+    return response.make_conditional(request)
 
 
 @app.route("/refresh/<geonameid>/")
@@ -126,19 +337,57 @@ def refresh(geonameid):
     ts = datetime.fromisoformat(city.timestamp)
     diff = now - ts
     assert diff >= min_data_refresh, "Data is still fresh, no need to update."
-    dh.get_city_by_geonameid(geonameid, force=True)
+    refresher.enqueue(geonameid)
+    flash("The data is being updated, check again in a bit!")
     return redirect(url_for("web", geonameid=geonameid))
 
 
 ##
 ## Active API endpoints
 ##
+# Output formats of the API: their mimetype and how to serialize a city.
+_OUTPUT_FORMATS = {
+    "xml": ("application/xml", create_output_xml),
+    "json": ("application/json", create_output_json),
+    "csv": ("text/csv", create_output_csv),
+    "ndjson": ("application/x-ndjson", lambda city: create_output_json(city) + b"\n"),
+}
+
+
+def _output_format():
+    """Return the format given by ?format=, or the best one for the Accept header (xml by default)."""
+    output_format = request.args.get("format")
+    if output_format is None:
+        formats = {mimetype: name for name, (mimetype, _) in _OUTPUT_FORMATS.items()}
+        output_format = formats[
+            request.accept_mimetypes.best_match(formats, default="application/xml")
+        ]
+    if output_format not in _OUTPUT_FORMATS:
+        abort(400, f"Invalid format, use one of: {', '.join(_OUTPUT_FORMATS)}.")
+    return output_format
+
+
 @app.route("/api/single/<city>/")
 def single_city(city, force=False):
     """API to get data for a single given city."""
-    return app.response_class(
-        get_single_city_data(city, force=force), mimetype="application/xml"
-    )
+    output_format = _output_format()
+    body = get_single_city_data(city, force=force, output_format=output_format)
+    if output_format == "csv":
+        body = create_output_csv() + body
+    response = app.response_class(body, mimetype=_OUTPUT_FORMATS[output_format][0])
+    response.vary.add("Accept")
+    return _with_etag(response, body)
+
+
+@app.route("/api/suggest/<prefix>/")
+def suggest(prefix):
+    """API to suggest the cities whose name starts with the given prefix, the largest first."""
+    n = min(max(request.args.get("n", 10, type=int), 1), 50)
+    response = jsonify(prefix=prefix, suggestions=dh.suggest(prefix, n))
+    # The suggestions barely change, so let browsers reuse them while the user types.
+    response.cache_control.public = True
+    response.cache_control.max_age = 60 * 60
+    return response
 
 
 @app.route("/api/force/<city>/")
@@ -150,27 +399,87 @@ def force_single_city(city):
 @app.route("/api/multi/<citylist>/")
 def multi_city(citylist, force=False):
     """API to fetch data for all cities in the given city list."""
-    response = ET.Element("multi", citylist=citylist)
-    for city in citylist.split("&"):
-        new_data = get_single_city_data(city, force)
-        response.append(ET.XML(new_data.decode("utf8")))
-    return app.response_class(ET.tostring(response), mimetype="application/xml")
+    output_format = _output_format()
+    # Get all cities concurrently, but stream them in the given order as they're ready.
+    cities = citylist.split("&")
+    futures = [
+        _multi_executor.submit(
+            _get_single_city_data_in_context, city, force, output_format
+        )
+        for city in cities
+    ]
+
+    # What goes before, between and after the cities.
+    if output_format == "xml":
+        citylist_attr = quoteattr(
+            citylist, {"\n": "&#10;", "\r": "&#13;", "\t": "&#09;"}
+        )
+        start = f"<multi citylist={citylist_attr}>".encode()
+        separator, end = b"", b"</multi>"
+    elif output_format == "json":
+        start, separator, end = b"[", b",", b"]"
+    elif output_format == "csv":
+        start, separator, end = create_output_csv(), b"", b""
+    else:
+        start, separator, end = b"", b"", b""
+
+    def generate():
+        yield start
+        for i, (city, future) in enumerate(zip(cities, futures)):
+            if i:
+                yield separator
+            try:
+                yield future.result()
+            except Exception:
+                # The status was already sent, answer this city with an error in its place.
+                app.logger.exception(f"Couldn't get the data for {city!r}.")
+                yield _OUTPUT_FORMATS[output_format][1](City.create_error_city(city))
+        yield end
+
+    response = app.response_class(
+        generate(), mimetype=_OUTPUT_FORMATS[output_format][0]
+    )
+    response.vary.add("Accept")
+    return response
+
 
+def _get_single_city_data_in_context(city, force=False, output_format="xml"):
+    """Run get_single_city_data from a worker thread, which needs its own app context."""
+    with app.app_context():
+        return get_single_city_data(city, force, output_format)
 
-def get_single_city_data(city, force=False):
-    """Main function that creates a response xml for a single city."""
+
+def get_single_city_data(city, force=False, output_format="xml"):
+    """Main function that creates a response (xml by default) for a single city."""
     assert city
     if city == "get-headers":
+        if output_format == "csv":
+            return b""  # The csv output always starts with its own header line.
         city_obj = City.create_headers_city()
     else:
-        city_info = city_search(city, max_results=1)
-        if city_info:
+        geonameid = dh.resolve_query(city)
+        city_obj = None
+        if geonameid:
             # If we found a result for this query, get the data for it.
-            city_obj = dh.get_city_by_geonameid(city_info[0].geonameid, query=city)
-        else:
+            try:
+                city_obj = dh.get_city_by_geonameid(geonameid, query=city)
+            except CityNotFound:
+                pass  # E.g., the search index has a city geonames removed.
+            else:
+                _retry_failed_sources(geonameid, city_obj)
+        if city_obj is None:
             # If not, we create a special City object to include in the response.
             city_obj = City.create_invalid_query_city(city)
-    return create_output_xml(city_obj)
+    with _SERIALIZE_SECONDS.time(output_format):
+        return _OUTPUT_FORMATS[output_format][1](city_obj)
+
+
+@app.route("/metrics")
+def metrics_endpoint():
+    """Latency histograms and counters of this worker, in the Prometheus text format."""
+    return app.response_class(
+        metrics.render(), content_type="text/plain; version=0.0.4; charset=utf-8"
+    )
 
 
 ##
@@ -183,6 +492,88 @@ def old_api(citystate):
     return f"Invalid endpoint, please check {url_for('api_info', _external=True, _scheme='https')} for up-to-date API info."
 
 
+##
+## Command line
+##
+@app.cli.command("upgrade-db")
+def upgrade_db():
+    """Create the missing tables and columns, and update the data stored by older versions."""
+    db.create_all()
+    for model in (CachedCity, CachedImage, CachedQuery):
+        _add_missing_columns(model.__table__)
+    click.echo(f"Updated {dh.upgrade_cached_cities()} cached cities.")
+
+
+@app.cli.command("warm-up")
+@click.argument("path", required=False, type=click.Path(exists=True, dir_okay=False))
+@click.option(
+    "--large-cities", "use_large_cities", is_flag=True, help="Warm up every large city."
+)
+@click.option(
+    "--workers", default=4, show_default=True, help="Cities fetched at the same time."
+)
+@click.option(
+    "--batch-size", default=20, show_default=True, help="Cities stored per commit."
+)
+@click.option(
+    "--rate-limit",
+    default=2.0,
+    show_default=True,
+    help="Max requests per second to each upstream host (0 for no limit).",
+)
+@click.option(
+    "--checkpoint",
+    type=click.Path(dir_okay=False),
+    help="File to record the finished cities, to resume [default: PATH.done].",
+)
+@click.option(
+    "--force", is_flag=True, help="Fetch the cities even if their data is fresh."
+)
+def warm_up_command(
+    path, use_large_cities, workers, batch_size, rate_limit, checkpoint, force
+):
+    """Fetch and store the cities (geonameids or queries, one per line) in PATH."""
+    if use_large_cities:
+        items = [city["name"] for city in large_cities.get_all_large_cities()]
+        checkpoint = checkpoint or "large_cities.done"
+    elif path:
+        items = read_items(path)
+        checkpoint = checkpoint or f"{path}.done"
+    else:
+        raise click.UsageError("Give a PATH or --large-cities.")
+
+    # A batch job, so requests wait for the rate limit as long as needed.
+    http_client.set_rate_limit(rate_limit or None, max_wait=None)
+    counts = warm_up(
+        app,
+        dh,
+        items,
+        workers=workers,
+        batch_size=batch_size,
+        older_than=None if force else min_data_refresh,
+        checkpoint=checkpoint,
+        echo=click.echo,
+    )
+    click.echo(f"Done: {dict(counts)}.")
+
+
+def _add_missing_columns(table):
+    """Add the columns (and their indexes) that were created after the table."""
+    existing = {c["name"] for c in inspect(db.engine).get_columns(table.name)}
+    with db.engine.begin() as conn:
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=db.engine.dialect)
+            conn.exec_driver_sql(
+                f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+            )
+            click.echo(f"Added column {table.name}.{column.name}.")
+    for index in table.indexes:
+        if any(column.name not in existing for column in index.columns):
+            index.create(db.engine)
+
+
 if __name__ == "__main__":
     # Threaded option to enable multiple instances for multiple user access support
     app.run(threaded=True, port=5000)
@@ -0,0 +1,46 @@
+# Score labels in the areavibes livability page -> City attribute names, in page order.
+_LABELS = {
+    "Livability": "overall_livability",
+    "Cost of Living": "cost_of_living",
+    "Crime": "safety",
+    "Housing": "housing",
+    "Schools": "schools",
+}
+
+
+def parse_scores(html):
+    """Return a dict(City attribute -> score) with all the scores found in a livability page.
+
+    Each score is the text of the tag right after its label, e.g.:
+    <em>Livability</em><i class="score">78</i>
+    The labels are searched in page order with a moving cursor, so the page is
+    scanned only once and never copied. Missing or empty scores are not included.
+    """
+    scores = {}
+    pos = 0
+    for label, attr in _LABELS.items():
+        flag = f"<em>{label}</em>"
+        flag_pos = html.find(flag, pos)
+        if flag_pos == -1:
+            continue
+        # Skip the first character after the label (the start of the score's tag).
+        pos = flag_pos + len(flag) + 1
+        start = html.find(">", pos) + 1
+        end = html.find("<", pos)
+        if 0 < start < end:
+            scores[attr] = html[start:end]
+    return scores
+
+
+if __name__ == "__main__":
+    # Parse and time saved livability pages:
+    #   python areavibes.py irvine-ca-livability.html [...]
+    import sys
+    import timeit
+
+    for filepath in sys.argv[1:]:
+        with open(filepath, encoding="utf8") as file_in:
+            page = file_in.read()
+        print(f"{filepath} ({len(page) / 1024:.0f}KB): {parse_scores(page)}")
+        runs, total = timeit.Timer(lambda: parse_scores(page)).autorange()
+        print(f"\t{total / runs * 1000:.3f}ms")
@@ -0,0 +1,153 @@
+import atexit
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import timedelta
+
+
+class TTLCache(object):
+    """Thread-safe LRU cache whose entries expire after a given time to live.
+
+    If maxbytes is given, entries are also evicted to keep the sum of their
+    sizes (as computed by sizeof) under it.
+    If a path is given the entries are also saved to that json file, so they
+    survive restarts. In that case the keys must be strings and the values
+    must be json serializable.
+    """
+
+    def __init__(
+        self,
+        maxsize=1024,
+        ttl=None,
+        *,
+        maxbytes=None,
+        sizeof=None,
+        path=None,
+        save_interval=60,
+    ):
+        if isinstance(ttl, timedelta):
+            ttl = ttl.total_seconds()
+        self.maxsize = maxsize
+        self.ttl = ttl  # in seconds, None means entries never expire.
+        self.maxbytes = maxbytes
+        self.currbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._sizeof = sizeof
+        self._data = OrderedDict()  # key -> (expiration time, value, size)
+        self._lock = threading.RLock()
+        self._path = path
+        self._save_interval = save_interval
+        self._last_save = time.time()
+        self._dirty = False
+        if path:
+            self._load()
+            atexit.register(self.save)
+
+    def get(self, key, default=None):
+        """Return the value for the given key if it's cached and still valid."""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or (entry[0] is not None and entry[0] < time.time()):
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def set(self, key, value, ttl=None):
+        """Cache the given value, evicting the least recently used entries if needed.
+        The ttl (in seconds or a timedelta) overrides the cache's ttl for this entry."""
+        if isinstance(ttl, timedelta):
+            ttl = ttl.total_seconds()
+        if ttl is None:
+            ttl = self.ttl
+        with self._lock:
+            expires = time.time() + ttl if ttl is not None else None
+            size = self._sizeof(value) if self._sizeof else 0
+            self._remove(key)
+            self._data[key] = (expires, value, size)
+            self.currbytes += size
+            while len(self._data) > self.maxsize or (
+                self.maxbytes is not None and self.currbytes > self.maxbytes
+            ):
+                self._remove(next(iter(self._data)))
+                self.evictions += 1
+            self._dirty = True
+            if self._path and time.time() - self._last_save >= self._save_interval:
+                self.save()
+
+    def pop(self, key, default=None):
+        """Remove the given key from the cache, returning its value."""
+        with self._lock:
+            entry = self._remove(key)
+            if entry is None:
+                return default
+            self._dirty = True
+            return entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.currbytes = 0
+            self._dirty = True
+
+    def _remove(self, key):
+        entry = self._data.pop(key, None)
+        if entry is not None:
+            self.currbytes -= entry[2]
+        return entry
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        """Return the current size and the hit/miss/eviction counters."""
+        with self._lock:
+            return {
+                "size": len(self._data),
+                "bytes": self.currbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+    def save(self):
+        """Write the valid entries to the cache file, if this cache has one."""
+        if not self._path:
+            return
+        with self._lock:
+            if not self._dirty:
+                return
+            now = time.time()
+            entries = [
+                [key, expires, value]
+                for key, (expires, value, _) in self._data.items()
+                if expires is None or expires >= now
+            ]
+            # Write to a temporary file first so readers never see a partial file.
+            tmp_path = f"{self._path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as file_out:
+                json.dump(entries, file_out)
+            os.replace(tmp_path, self._path)
+            self._last_save = now
+            self._dirty = False
+
+    def _load(self):
+        """Load the valid entries from the cache file, if it exists."""
+        try:
+            with open(self._path) as file_in:
+                entries = json.load(file_in)
+        except (OSError, ValueError):
+            return
+        now = time.time()
+        for key, expires, value in entries[-self.maxsize :]:
+            if expires is None or expires >= now:
+                size = self._sizeof(value) if self._sizeof else 0
+                self._data[key] = (expires, value, size)
+                self.currbytes += size
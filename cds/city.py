@@ -1,20 +1,109 @@
-import requests
 import urllib.parse
 import json
+import copy
+import logging
+import math
+import time
+import http_client
 import utils
+import areavibes
 import weather
 import large_cities
+import geonames_index
 import living_wages
+import metrics
 from datetime import datetime
-from jsonpickle import encode, decode
-import base64
+import jsonpickle
+import hashlib
 from os import getenv
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Pool shared by all cities to fetch their data sources concurrently.
+_fetch_executor = ThreadPoolExecutor(
+    max_workers=int(getenv("CDS_FETCH_WORKERS", "10")),
+    thread_name_prefix="city-fetch",
+)
+
+_FETCH_SECONDS = metrics.Histogram(
+    "cds_city_fetch_seconds", "Time to fetch all the data of a city.", timing="fetch"
+)
+_SOURCE_SECONDS = metrics.Histogram(
+    "cds_source_seconds",
+    "Time to fetch each data source of a city.",
+    ["source"],
+    timing="source",
+)
+_SOURCE_FAILURES = metrics.Counter(
+    "cds_source_failures_total", "Data sources that failed or timed out.", ["source"]
+)
+_SEARCH_SECONDS = metrics.Histogram(
+    "cds_search_seconds", "Time to search for a city.", ["backend"], timing="search"
+)
+
+
+class CityNotFound(LookupError):
+    """Geonames doesn't have a city with the requested geonameid."""
+
 
 class City(object):
+    # Data sources that only depend on the geonames data, with their timeouts in seconds.
+    _SOURCE_TIMEOUTS = {
+        "_fetch_areavibes": 20,
+        "_fetch_city_image": 20,
+        "_fetch_weather": 30,
+        "_fetch_living_wages": 30,
+        "_find_nearby_major_cities": 5,
+    }
+    # Max seconds a source can wait for a thread of the shared pool before it's given up.
+    _MAX_QUEUE_WAIT = 30
+
+    # Sources that failed in the last fetch, see fetch_data(); cities stored by
+    # older versions don't list them.
+    failed_sources = ()
+
+    # Version of the stored format, see to_dict().
+    SCHEMA_VERSION = 1
+    # Attributes stored for each city, anything else (e.g. the query) isn't kept.
+    _SCHEMA_FIELDS = (
+        "geonameid",
+        "full_name",
+        "name",
+        "state",
+        "country",
+        "county",
+        "population",
+        "coordinates",
+        "bounding_box",
+        "tz",
+        "wikipedia_url",
+        "citystate",
+        "overall_livability",
+        "cost_of_living",
+        "housing",
+        "schools",
+        "safety",
+        "img",
+        "img_type",
+        "weather_year",
+        "weather",
+        "living_wages",
+        "nearby_major_cities",
+        "closest_major_cities",
+        "timestamp",
+        "error_code",
+        "radius_nearby_major_cities",
+        "_max_nearby_major_cities",
+        "_fetched",
+        "failed_sources",
+    )
+    # Stored as json lists, but used as tuples.
+    _TUPLE_FIELDS = ("coordinates", "weather")
+
     def __init__(
         self,
         geonameid,
@@ -32,35 +121,109 @@ class City(object):
         self.radius_nearby_major_cities = radius_nearby_major_cities
         self._fetched = fetch
 
-    def fetch_data(self):
+    def fetch_data(self, *, concurrent=True):
         # Can add a check here if it's past a threshold from timestamp then refresh the data.
         if self._fetched:
             return
 
         # Populate the city attributes.
-        self._fetch_geonames()
-        self._fetch_areavibes()
-        self._fetch_city_image()
-        self._fetch_weather()
-        self._fetch_living_wages()
-        self._find_nearby_major_cities()
+        # Names of the sources that failed or timed out, and were set to N/A.
+        self.failed_sources = []
+        with _FETCH_SECONDS.time():
+            # Every other source depends on the geonames data, so it goes first.
+            with _SOURCE_SECONDS.time("geonames"):
+                self._fetch_geonames()
+            if concurrent:
+                self._fetch_sources_concurrently()
+            else:
+                for source in City._SOURCE_TIMEOUTS:
+                    with _SOURCE_SECONDS.time(_source_name(source)):
+                        getattr(self, source)()
 
         # Timestamp this data for freshness and mark this city as fetched.
         self.timestamp = datetime.utcnow().isoformat()
         self._fetched = True
 
+    def _fetch_sources_concurrently(self):
+        """Run all data sources in parallel; the ones that fail or time out are set to N/A
+        and listed in failed_sources."""
+        start = time.monotonic()
+        base = dict(self.__dict__)
+        # When each source started running, its timeout doesn't count the wait for a thread.
+        started = {}
+        # Each source works on its own copy so a late or failed one can't leave partial data.
+        futures = {
+            source: _fetch_executor.submit(
+                _run_source, copy.copy(self), source, started
+            )
+            for source in City._SOURCE_TIMEOUTS
+        }
+        for source, future in futures.items():
+            try:
+                scratch, elapsed = _wait_for_source(source, future, start, started)
+            except Exception:
+                logger.exception(f"Data source {source} failed for {self}.")
+                _SOURCE_FAILURES.inc(_source_name(source))
+                self.__dict__.update(self._source_defaults(source))
+                self.failed_sources.append(_source_name(source))
+                continue
+            # It ran in another thread, so add it to this request's timings here.
+            metrics.add_request_timing(f"source-{_source_name(source)}", elapsed)
+            self.__dict__.update(
+                {
+                    k: v
+                    for k, v in scratch.__dict__.items()
+                    if k not in base or base[k] is not v
+                }
+            )
+
+    @staticmethod
+    def _source_defaults(source):
+        """Return the attributes to use when the given data source couldn't be fetched."""
+        if source == "_fetch_areavibes":
+            return {
+                "overall_livability": "N/A",
+                "cost_of_living": "N/A",
+                "housing": "N/A",
+                "schools": "N/A",
+                "safety": "N/A",
+            }
+        if source == "_fetch_city_image":
+            return {"img": "N/A"}
+        if source == "_fetch_weather":
+            return {
+                "weather_year": datetime.now().year - 1,
+                "weather": ("N/A",) * 5,
+            }
+        if source == "_fetch_living_wages":
+            return {"living_wages": "N/A"}
+        if source == "_find_nearby_major_cities":
+            return {"nearby_major_cities": [], "closest_major_cities": []}
+        raise ValueError(f"Unknown data source '{source}'.")
+
     def _fetch_geonames(self):
         """Fetch city data from geonames."""
 
         geonames_user = getenv("GEONAMES_USER", "demo")
         url = f"http://api.geonames.org/getJSON?geonameId={self.geonameid}&username={geonames_user}"
-        resp_city = requests.get(url)
-        if resp_city.status_code != 200:
-            self.error_code = resp_city.status_code
-            return
+        resp_city = http_client.get(url, is_error=_geonames_error)
+        # Every other source needs this data, so without it the whole fetch fails
+        # (and nothing is cached) instead of filling the city with N/A.
+        error = _geonames_error(resp_city)
+        if error:
+            raise http_client.UpstreamError(
+                f"Geonames failed for {self.geonameid}: {error}",
+                retry_after=http_client.retry_after(resp_city),
+            )
 
         # Parse a valid response.
         data = json.loads(resp_city.text)
+        # Any other error is permanent (e.g., the geonameid doesn't exist), so
+        # don't make up an N/A city to store in its place.
+        status = data.get("status")
+        if isinstance(status, dict):
+            message = status.get("message") or f"error {status.get('value')}"
+            raise CityNotFound(f"Geonames has no city {self.geonameid}: {message}")
 
         self.name = data.get("toponymName", "N/A")
         self.state = data.get("adminCodes1", {}).get("ISO3166_2", "")
@@ -89,7 +252,7 @@ class City(object):
         self.safety = "N/A"
 
         livability_url = f"https://www.areavibes.com/{self.citystate if retry is None else retry}/livability"
-        resp = requests.get(livability_url)
+        resp = http_client.get(livability_url)
         if resp.status_code == 404 and retry is None:
             # If we couldn't find it, retry.
             # This logic is for NYC, but maybe it solves other cities as well.
@@ -102,61 +265,21 @@ class City(object):
         if resp.status_code != 200:
             return
 
-        html = resp.text
-
-        # Parse the overall livability score.
-        liv_flag = "<em>Livability</em>"
-        html = html[html.find(liv_flag) + len(liv_flag) + 1 :]
-        liv_start = html.find(">") + 1
-        liv_end = html.find("<")
-        livability = html[liv_start:liv_end]
-        if livability:
-            self.overall_livability = livability
-
-        # Parse the cost of living score.
-        col_flag = "<em>Cost of Living</em>"
-        html = html[html.find(col_flag) + len(col_flag) + 1 :]
-        col_start = html.find(">") + 1
-        col_end = html.find("<")
-        col = html[col_start:col_end]
-        if col:
-            self.cost_of_living = col
-
-        # Parse the safety score.
-        crm_flag = "<em>Crime</em>"
-        html = html[html.find(crm_flag) + len(crm_flag) + 1 :]
-        crm_start = html.find(">") + 1
-        crm_end = html.find("<")
-        crime = html[crm_start:crm_end]
-        if crime:
-            self.safety = crime
-
-        # Parse the housing score.
-        hou_flag = "<em>Housing</em>"
-        html = html[html.find(hou_flag) + len(hou_flag) + 1 :]
-        hou_start = html.find(">") + 1
-        hou_end = html.find("<")
-        housing = html[hou_start:hou_end]
-        if housing:
-            self.housing = housing
-
-        # Parse the schools score.
-        sch_flag = "<em>Schools</em>"
-        html = html[html.find(sch_flag) + len(sch_flag) + 1 :]
-        sch_start = html.find(">") + 1
-        sch_end = html.find("<")
-        schools = html[sch_start:sch_end]
-        if schools:
-            self.schools = schools
+        # Parse the livability, cost of living, safety, housing and schools scores.
+        self.__dict__.update(areavibes.parse_scores(resp.text))
 
     def _fetch_city_image(self):
         """Find an image from this city."""
         self.img = "N/A"
         api_key = getenv("CDS_GOOGLE_API_KEY", "")
-        assert api_key
+        if not api_key:
+            # Images are disabled without a key, that's not a failure to retry.
+            return
 
         query1_url = f"https://maps.googleapis.com/maps/api/place/findplacefromtext/json?input={self.full_name}&key={api_key}&inputtype=textquery&fields=photos"
-        resp1 = requests.get(query1_url)
+        resp1 = http_client.get(query1_url)
+        if resp1.status_code != 200:
+            return
         data1 = json.loads(resp1.text)
 
         candidates = data1.get("candidates", None)
@@ -172,14 +295,27 @@ class City(object):
             return
 
         query2_url = f"https://maps.googleapis.com/maps/api/place/photo?photoreference={photo_ref}&key={api_key}&maxwidth=800&maxheight=800"
-        resp2 = requests.get(query2_url)
-        self.img = "data:image/jpg;base64," + base64.b64encode(resp2.content).decode()
+        resp2 = http_client.get(query2_url)
+        if resp2.status_code != 200:
+            return
+        # The image itself is stored apart from the city data, see pop_image().
+        self.img = hashlib.sha256(resp2.content).hexdigest()
+        self.img_type = resp2.headers.get("Content-Type", "image/jpeg")
+        self._img_content = resp2.content
+
+    def pop_image(self):
+        """Remove and return (digest, content type, content) of the fetched image, if there's one."""
+        content = self.__dict__.pop("_img_content", None)
+        if content is None:
+            return None
+        return self.img, self.img_type, content
 
     def _fetch_weather(self):
         """Get the weather data from the previous full year."""
         self.weather_year = datetime.now().year - 1
-        self.weather = weather.get_year_round_weather(
-            self.coordinates, self.weather_year
+        # Stations without some of the temperatures give NaN summaries.
+        self.weather = _json_safe(
+            weather.get_year_round_weather(self.coordinates, self.weather_year)
         )
 
     def _fetch_living_wages(self):
@@ -224,14 +360,41 @@ class City(object):
     def __repr__(self):
         return self.__str__()
 
+    def to_dict(self):
+        """Return the stored attributes as a dict that can be serialized to json."""
+        data = {"v": City.SCHEMA_VERSION}
+        for field in City._SCHEMA_FIELDS:
+            if field in self.__dict__:
+                data[field] = _json_safe(self.__dict__[field])
+        return data
+
+    @staticmethod
+    def from_dict(data):
+        """Create a city from a dict created by to_dict()."""
+        if data.get("v") != City.SCHEMA_VERSION:
+            raise ValueError(f"Unsupported city schema version: {data.get('v')}.")
+        city = City.__new__(City)
+        for field in City._SCHEMA_FIELDS:
+            if field in data:
+                value = data[field]
+                if field in City._TUPLE_FIELDS and isinstance(value, list):
+                    value = tuple(value)
+                setattr(city, field, value)
+        return city
+
     def to_json(self):
         """Serialize the object to a json for storage."""
-        return encode(self)
+        return json.dumps(self.to_dict(), separators=(",", ":"))
 
     @staticmethod
     def from_json(s):
-        """Load a serialized object from storage."""
-        return decode(s)
+        """Load a serialized object from storage; accepts the parsed dict as well."""
+        if isinstance(s, str):
+            if s.startswith('{"py/object"'):
+                # Stored by older versions with jsonpickle.
+                return jsonpickle.decode(s)
+            s = json.loads(s)
+        return City.from_dict(s)
 
     @staticmethod
     def create_headers_city():
@@ -252,9 +415,20 @@ class City(object):
 
     @staticmethod
     def create_invalid_query_city(query):
+        return City._create_na_city(query, f'Could not find a city for query="{query}"')
+
+    @staticmethod
+    def create_error_city(query):
+        """City to answer a query whose data couldn't be fetched right now."""
+        return City._create_na_city(
+            query, f'Could not get the data for query="{query}", try again later'
+        )
+
+    @staticmethod
+    def _create_na_city(query, full_name):
         headers = City(None)
         headers.query = query
-        headers.full_name = f'Could not find a city for query="{query}"'
+        headers.full_name = full_name
         headers.population = "N/A"
         headers.weather = ["N/A"]
         headers.overall_livability = "N/A"
@@ -268,6 +442,81 @@ class City(object):
         return headers
 
 
+def _json_safe(value):
+    """Replace the NaN and infinite floats in a value with "N/A", strict json (e.g., MySQL's) rejects them."""
+    if isinstance(value, float) and not math.isfinite(value):
+        return "N/A"
+    if isinstance(value, (list, tuple)):
+        return type(value)(_json_safe(v) for v in value)
+    if isinstance(value, dict):
+        return {k: _json_safe(v) for k, v in value.items()}
+    return value
+
+
+def _run_source(city, source, started=None):
+    """Fetch a single data source into the given city, returning it and how long it took.
+
+    If a started dict is given, the time.monotonic() when it starts is set in it.
+    """
+    if started is not None:
+        started[source] = time.monotonic()
+    start = time.perf_counter()
+    getattr(city, source)()
+    elapsed = time.perf_counter() - start
+    _SOURCE_SECONDS.observe(elapsed, _source_name(source))
+    return city, elapsed
+
+
+def _wait_for_source(source, future, submitted, started):
+    """Return the result of a source, waiting up to its timeout from when it started running.
+
+    Raises TimeoutError if it runs for longer than that, or if it waits for a
+    thread for longer than City._MAX_QUEUE_WAIT (then it won't run at all).
+    """
+    while True:
+        start = started.get(source)
+        if start is None:
+            deadline = submitted + City._MAX_QUEUE_WAIT
+        else:
+            deadline = start + City._SOURCE_TIMEOUTS[source]
+        try:
+            return future.result(timeout=max(deadline - time.monotonic(), 0))
+        except FuturesTimeoutError:
+            # Keep waiting if it started running meanwhile.
+            if started.get(source) == start:
+                future.cancel()
+                raise
+
+
+def _source_name(source):
+    """Name of a data source for the metrics, e.g. "_fetch_city_image" -> "city_image"."""
+    return source.lstrip("_").replace("fetch_", "", 1).replace("find_", "", 1)
+
+
+# Errors that geonames answers with a 200 and are temporary: database timeout,
+# exceeded daily, hourly or weekly credits, and overloaded server.
+_GEONAMES_TEMPORARY_ERRORS = (13, 18, 19, 20, 22)
+
+
+def _geonames_error(response):
+    """Return why a geonames API response doesn't have the requested data, None if it does.
+
+    Errors that aren't temporary (e.g., a geonameid that doesn't exist) return
+    None, so they don't count as failures of the service: a search answers them
+    with no results, and a city fetch raises CityNotFound.
+    """
+    if response.status_code != 200:
+        return f"HTTP {response.status_code}"
+    try:
+        data = json.loads(response.text)
+    except ValueError:
+        return "invalid json"
+    status = data.get("status") if isinstance(data, dict) else None
+    if isinstance(status, dict) and status.get("value") in _GEONAMES_TEMPORARY_ERRORS:
+        return status.get("message") or f"error {status['value']}"
+    return None
+
+
 def search(cityname, max_results=1):
     """Find the best match results for the given city name."""
 
@@ -287,9 +536,23 @@ def search(cityname, max_results=1):
     if max_results < 1:
         return []
 
+    # Use the local index if we have one, it has the same cities as the geonames search.
+    if geonames_index.available():
+        with _SEARCH_SECONDS.time("index"):
+            results = geonames_index.search(cityname, max_results)
+        return [City(geonameid, name) for geonameid, name in results]
+
     geonames_user = getenv("GEONAMES_USER", "demo")
     url = f"http://api.geonames.org/searchJSON?&maxRows={max_results}&lang=en&username={geonames_user}&q={cityname}"
-    response = requests.get(url)
+    with _SEARCH_SECONDS.time("geonames"):
+        response = http_client.get(url, is_error=_geonames_error)
+    # Don't mistake an error for a search without results, those are cached.
+    error = _geonames_error(response)
+    if error:
+        raise http_client.UpstreamError(
+            f"Geonames search failed: {error}",
+            retry_after=http_client.retry_after(response),
+        )
     data = json.loads(response.text)
 
     return [
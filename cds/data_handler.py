@@ -1,55 +1,522 @@
-from city import City
+from city import City, search as city_search
+from cache import TTLCache
+from search_index import normalize
+from suggestions import Suggestions, population_count
+from concurrent.futures import Future
+from contextlib import contextmanager
 from datetime import datetime, timedelta
-from sqlalchemy.sql import select
+from sqlalchemy import text
+from sqlalchemy.exc import IntegrityError
+import base64
+import copy
+import geonames_index
+import hashlib
+import json
+import large_cities
+import metrics
+import threading
 from random import sample
 
 
+_DB_SECONDS = metrics.Histogram(
+    "cds_db_seconds",
+    "Time of the cached cities reads, decodes and commits.",
+    ["operation"],
+    timing="db",
+)
+_LOOKUPS = metrics.Counter(
+    "cds_city_lookups_total", "Cities looked up, by where they were found.", ["source"]
+)
+
+
 class DataHandler(object):
     UPDATE_RECENT_FREQUENCY = timedelta(days=1)
+    # Max seconds to wait for another worker that's fetching the same city.
+    FETCH_LOCK_TIMEOUT = 60
+    # How long to keep the city found for a query, and the queries without a city.
+    QUERY_TTL = timedelta(weeks=4)
+    NO_CITY_QUERY_TTL = timedelta(days=1)
 
-    def __init__(self, db, table):
+    def __init__(
+        self,
+        db,
+        table,
+        image_table,
+        query_table,
+        *,
+        cache_ttl=None,
+        cache_size=2000,
+        cache_bytes=64 * 2**20,
+    ):
         self._db = db
         self._table = table
-        self._recent_cities = tuple()
+        self._image_table = image_table
+        self._query_table = query_table
+        # Decoded cities by geonameid, to skip the DB and the decoding for popular cities.
+        # Each worker has its own, and a city refreshed or forced by another worker
+        # isn't dropped from it: this worker serves its copy until cache_ttl expires.
+        self._cities = TTLCache(
+            maxsize=cache_size, ttl=cache_ttl, maxbytes=cache_bytes, sizeof=_city_size
+        )
+        # Normalized query -> geonameid (None if there's no city for it).
+        self._queries = TTLCache(maxsize=20000, ttl=DataHandler.QUERY_TTL)
+        metrics.register_cache("cities", self._cities)
+        metrics.register_cache("queries", self._queries)
+        # Loads in progress by (geonameid, force), so concurrent requests share them.
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
+        # Built on first use from the cached cities and the large cities.
+        self._suggestions = None
+        self._suggestions_lock = threading.Lock()
+        # Background writer of the fetched cities, see set_writer().
+        self._writer = None
+        self._recent_cities = []
+        self._recent_pool_size = 15
         self._last_recent_check = datetime(1908, 3, 25)
 
+    def set_writer(self, writer):
+        """Store the fetched cities with a WriteBehind instead of committing them in the request."""
+        self._writer = writer
+
+    def resolve_query(self, query):
+        """Return the geonameid of the best match for the query, None if there's no city for it."""
+        key = normalize(query)[:300]
+        geonameid = self._queries.get(key, _MISSING)
+        if geonameid is not _MISSING:
+            return geonameid
+
+        now = datetime.utcnow()
+        cached = self._query_table.query.get(key)
+        if cached and now - cached.timestamp < self._query_ttl(cached.geonameid):
+            geonameid = cached.geonameid
+        else:
+            results = city_search(query, max_results=1)
+            geonameid = str(results[0].geonameid) if results else None
+            if not cached:
+                cached = self._query_table(query_key=key)
+            cached.geonameid = geonameid
+            cached.timestamp = now
+            self._db.session.add(cached)
+            try:
+                self._commit()
+            except IntegrityError:
+                # Another worker stored the same query at the same time.
+                self._db.session.rollback()
+        self._queries.set(key, geonameid, ttl=self._query_ttl(geonameid))
+        return geonameid
+
+    @staticmethod
+    def _query_ttl(geonameid):
+        if geonameid is None:
+            return DataHandler.NO_CITY_QUERY_TTL
+        return DataHandler.QUERY_TTL
+
     def get_city_by_geonameid(self, geonameid, *, force=False, query="N/A"):
         # Make sure the given ID is valid.
         assert isinstance(geonameid, int) or (
             isinstance(geonameid, str) and geonameid.isdecimal()
         ), "The geonameID should be a decimal value."
 
+        key = str(geonameid)
+        if force:
+            self._cities.pop(key)
+        data = self._cities.get(key)
+        if data is not None:
+            _LOOKUPS.inc("memory")
+        else:
+            data = self._single_flight(
+                (key, force), lambda: self._get_from_db(geonameid, force=force)
+            )
+
+        # Adds the query that got this city, to a copy so the cached one isn't changed.
+        data = copy.copy(data)
+        data.query = query
+        return data
+
+    def refresh_city(self, geonameid, *, older_than):
+        """Fetch the city's data again, unless the stored data is newer than the given age."""
+        if self.is_fresh(geonameid, older_than=older_than):
+            # Another worker already refreshed it, just drop our old copy.
+            self._cities.pop(str(geonameid))
+            return
+        self.get_city_by_geonameid(geonameid, force=True)
+
+    def is_fresh(self, geonameid, *, older_than):
+        """Return whether the city is stored with data newer than the given age.
+
+        Cities with sources that failed in their last fetch are never fresh.
+        """
+        pending = self._writer.get(geonameid) if self._writer is not None else None
+        if pending is not None:
+            # Just fetched, it's waiting to be written.
+            return not pending.failed_sources
         cached = self._table.query.get(geonameid)
+        return bool(
+            cached
+            and cached.timestamp
+            and datetime.utcnow() - cached.timestamp < older_than
+            and not (isinstance(cached.data, dict) and cached.data.get("failed_sources"))
+        )
+
+    def _single_flight(self, key, load):
+        """Run load() for the given key, unless it's already running, and cache its result."""
+        with self._inflight_lock:
+            future = self._inflight.get(key)
+            leader = future is None
+            if leader:
+                future = self._inflight[key] = Future()
+        if not leader:
+            # Wait for the request that's already loading this city.
+            return future.result()
+
+        try:
+            data = load()
+            self._cities.set(key[0], data)
+            future.set_result(data)
+            return data
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._inflight_lock:
+                del self._inflight[key]
+
+    def _get_from_db(self, geonameid, *, force=False):
+        """Return the city stored in the DB, fetching and storing it first if needed."""
+        if self._writer is not None and not force:
+            data = self._writer.get(geonameid)
+            if data is not None:
+                _LOOKUPS.inc("pending")
+                return data
+        with _DB_SECONDS.time("read"):
+            cached = self._table.query.get(geonameid)
         if force or not cached:
-            data = City(geonameid)
-            data.fetch_data()
-            assert data._fetched  # make sure the data was fetched before commiting it.
-            if not cached:
-                # If it's a new city, create a new entry.
-                cached = self._table(geonameid=geonameid, data=data.to_json())
+            seen_timestamp = cached.timestamp if cached else None
+            # End the current transaction so we can see what other workers stored.
+            self._db.session.rollback()
+            with self._fetch_lock(geonameid):
+                cached = self._table.query.get(geonameid)
+                if cached and (not force or cached.timestamp != seen_timestamp):
+                    # Another worker stored (or refreshed) it while we waited.
+                    _LOOKUPS.inc("db")
+                    with _DB_SECONDS.time("decode"):
+                        return City.from_json(cached.data)
+
+                # Don't keep the session's connection during the fetch, the lock already holds one.
+                self._db.session.rollback()
+                data = City(geonameid)
+                data.fetch_data()
+                assert data._fetched  # make sure the data was fetched before commiting it.
+                image = data.pop_image()
+                writer = self._writer
+                if (
+                    writer is None
+                    or not self._can_write_later(geonameid, data)
+                    or not writer.add(geonameid, data, image)
+                ):
+                    self._store(geonameid, data, image)
+                _LOOKUPS.inc("fetched")
+        else:
+            _LOOKUPS.inc("db")
+            with _DB_SECONDS.time("decode"):
+                data = City.from_json(cached.data)
+            if self._upgrade_cached(cached, data):
+                self._commit()
+        return data
+
+    @contextmanager
+    def _fetch_lock(self, geonameid):
+        """Hold a lock shared by all workers while fetching the given city (MySQL only).
+
+        The lock belongs to a connection of its own: the session's connection goes
+        back to the pool on every commit or rollback, and the lock would stay with it.
+        The pool is sized for that, see SQLALCHEMY_ENGINE_OPTIONS in app.py.
+        """
+        if self._db.engine.dialect.name != "mysql":
+            yield
+            return
+        name = f"cds-fetch-{geonameid}"
+        with self._db.engine.connect() as conn:
+            acquired = conn.execute(
+                text("SELECT GET_LOCK(:name, :timeout)"),
+                {"name": name, "timeout": DataHandler.FETCH_LOCK_TIMEOUT},
+            ).scalar()
+            try:
+                # If we timed out waiting, fetch it anyway.
+                yield
+            finally:
+                if acquired == 1:
+                    conn.execute(text("SELECT RELEASE_LOCK(:name)"), {"name": name})
+
+    def _store(self, geonameid, data, image=None):
+        """Store a freshly fetched city and its image (by default, the one it fetched) in the DB."""
+        image = image or data.pop_image()
+        for attempt in range(2):
+            self._stage(geonameid, data, image)
+            try:
+                self._commit()
+                break
+            except IntegrityError:
+                # Another worker inserted the same city or image at the same time.
+                self._db.session.rollback()
+                if attempt:
+                    raise
+        self._stored(geonameid, data)
+
+    def store_many(self, cities):
+        """Store freshly fetched cities, given as (geonameid, City) pairs, in a single commit."""
+        images = [data.pop_image() for _, data in cities]
+        for (geonameid, data), image in zip(cities, images):
+            self._stage(geonameid, data, image)
+        try:
+            self._commit()
+        except IntegrityError:
+            # Another worker inserted some of them at the same time, retry them one by one.
+            self._db.session.rollback()
+            for (geonameid, data), image in zip(cities, images):
+                self._store(geonameid, data, image)
+            return
+        for geonameid, data in cities:
+            # Drop our old copy, if there's one.
+            self._cities.pop(str(geonameid))
+            self._stored(geonameid, data)
+
+    def _can_write_later(self, geonameid, data):
+        """Check, while in the request, what could make the background write of a city fail."""
+        try:
+            self._set_summary(self._table(geonameid=str(geonameid)), data)
+            json.dumps(data.to_dict(), allow_nan=False)
+        except (AttributeError, TypeError, ValueError):
+            # Store it now, so the error reaches the request and the city isn't cached.
+            return False
+        return True
+
+    def discard(self, geonameid):
+        """Forget a fetched city that couldn't be written, so it's fetched again."""
+        self._cities.pop(str(geonameid))
+
+    def write_many(self, cities):
+        """Upsert cities, given as (geonameid, City, image) tuples, in a single commit."""
+        images = {image[0]: image for _, _, image in cities if image}
+        if images:
+            stored = self._db.session.query(self._image_table.digest).filter(
+                self._image_table.digest.in_(images)
+            )
+            for (digest,) in stored:
+                del images[digest]
+        rows = []
+        for geonameid, data, _ in cities:
+            row = self._table(geonameid=str(geonameid), data=data.to_dict())
+            self._set_summary(row, data)
+            rows.append(row)
+
+        dialect = self._db.engine.dialect.name
+        if dialect not in ("mysql", "sqlite"):
+            # No upsert statement, merge them one by one.
+            for row in rows:
+                self._db.session.merge(row)
+            for image in images.values():
+                self._add_image(*image)
+        else:
+            if dialect == "mysql":
+                from sqlalchemy.dialects.mysql import insert
             else:
-                # If it's an old city, update the existing entry.
-                cached.data = data.to_json()
+                from sqlalchemy.dialects.sqlite import insert
+            columns = [c.name for c in self._table.__table__.columns]
+            values = [{c: getattr(row, c) for c in columns} for row in rows]
+            upsert = insert(self._table.__table__)
+            if dialect == "mysql":
+                upsert = upsert.on_duplicate_key_update(
+                    {c: upsert.inserted[c] for c in columns if c != "geonameid"}
+                )
+            else:
+                upsert = upsert.on_conflict_do_update(
+                    index_elements=["geonameid"],
+                    set_={c: upsert.excluded[c] for c in columns if c != "geonameid"},
+                )
+            # Executed with a list of rows, so the driver batches them in statements of a safe size.
+            self._db.session.execute(upsert, values)
+            if images:
+                # Another worker may store the same image meanwhile, images are content-addressed.
+                insert_images = insert(self._image_table.__table__)
+                if dialect == "mysql":
+                    insert_images = insert_images.prefix_with("IGNORE")
+                else:
+                    insert_images = insert_images.on_conflict_do_nothing()
+                self._db.session.execute(
+                    insert_images,
+                    [
+                        {"digest": digest, "content_type": content_type, "data": content}
+                        for digest, content_type, content in images.values()
+                    ],
+                )
+        self._commit()
+        for geonameid, data, _ in cities:
+            self._stored(geonameid, data)
+
+    def rollback(self):
+        self._db.session.rollback()
+
+    def _commit(self):
+        with _DB_SECONDS.time("commit"):
+            self._db.session.commit()
+
+    def _stage(self, geonameid, data, image):
+        """Add a city and its image to the session, without committing it."""
+        if image:
+            self._add_image(*image)
+        cached = self._table.query.get(geonameid)
+        if not cached:
+            # If it's a new city, create a new entry.
+            cached = self._table(geonameid=geonameid)
+        # If it's an old city, update the existing entry.
+        cached.data = data.to_dict()
+        self._set_summary(cached, data)
+        self._db.session.add(cached)
+
+    def _stored(self, geonameid, data):
+        """Update the recent cities and the suggestions with a city that was just stored."""
+        self._add_recent_city(data)
+        if self._suggestions is not None:
+            self._suggestions.add(
+                data.full_name, population_count(data.population), str(geonameid)
+            )
+
+    def cache_stats(self):
+        """Return the size and hit/miss/eviction counters of the decoded cities cache."""
+        return self._cities.stats()
+
+    def _upgrade_cached(self, cached, data):
+        """Update a cached city stored by older versions; returns whether it changed."""
+        # Older versions stored a jsonpickle string instead of the city's dict.
+        changed = not isinstance(cached.data, dict)
+        if cached.timestamp is None or cached.population is None:
+            # Stored before the summary columns existed.
+            changed = True
+        if data.img.startswith("data:"):
+            # Move images stored inline by older versions to the images table.
+            self._move_inline_image(data)
+            changed = True
+        if changed:
+            cached.data = data.to_dict()
+            self._set_summary(cached, data)
             self._db.session.add(cached)
+        return changed
+
+    @staticmethod
+    def _set_summary(cached, data):
+        """Copy the columns used to list cities without decoding their data."""
+        cached.timestamp = datetime.fromisoformat(data.timestamp)
+        cached.name = data.name
+        cached.full_name = data.full_name
+        cached.population = population_count(data.population)
+
+    def upgrade_cached_cities(self, batch_size=100):
+        """Update all the cached cities stored by older versions; returns how many changed."""
+        geonameids = [
+            row[0] for row in self._db.session.query(self._table.geonameid).all()
+        ]
+        count = 0
+        for i in range(0, len(geonameids), batch_size):
+            for geonameid in geonameids[i : i + batch_size]:
+                cached = self._table.query.get(geonameid)
+                count += self._upgrade_cached(cached, City.from_json(cached.data))
             self._db.session.commit()
-        else:
-            data = City.from_json(cached.data)
-        # Adds the query that got this city.
-        data.query = query
-        return data
+        return count
+
+    def get_image(self, digest):
+        """Return the stored image with the given digest, None if there isn't one."""
+        pending = self._writer.get_image(digest) if self._writer is not None else None
+        if pending is not None:
+            content_type, content = pending
+            return self._image_table(digest=digest, content_type=content_type, data=content)
+        return self._image_table.query.get(digest)
+
+    def _add_image(self, digest, content_type, content):
+        """Add an image to the session unless it's already stored; images are content-addressed."""
+        if self._image_table.query.get(digest) is not None:
+            return
+        self._db.session.add(
+            self._image_table(digest=digest, content_type=content_type, data=content)
+        )
+
+    def _move_inline_image(self, data):
+        """Replace a base64 data URI image with a reference to the images table."""
+        header, encoded = data.img.split(",", 1)
+        content = base64.b64decode(encoded)
+        content_type = header[len("data:") :].split(";")[0]
+        data.img = hashlib.sha256(content).hexdigest()
+        data.img_type = content_type
+        self._add_image(data.img, content_type, content)
+
+    def suggest(self, prefix, n=10):
+        """Return up to n cities whose name starts with the given prefix, the largest first."""
+        if self._suggestions is None:
+            self._load_suggestions()
+        return self._suggestions.suggest(prefix, n)
+
+    def _load_suggestions(self):
+        with self._suggestions_lock:
+            if self._suggestions is not None:
+                return
+            suggestions = Suggestions()
+            # The large cities don't have a geonameid, so they're only suggested
+            # if the local geonames index can find it (the client needs it).
+            if geonames_index.available():
+                for city in large_cities.get_all_large_cities():
+                    found = geonames_index.search(city["name"])
+                    if found and _same_name(found[0][1], city["name"]):
+                        geonameid, full_name = found[0]
+                        suggestions.add(
+                            full_name, population_count(city["population"]), str(geonameid)
+                        )
+            rows = self._db.session.query(
+                self._table.geonameid, self._table.full_name, self._table.population
+            ).filter(self._table.full_name.isnot(None))
+            for geonameid, full_name, population in rows:
+                suggestions.add(full_name, population or 0, geonameid)
+            self._suggestions = suggestions
 
     def get_recent_cities(self, n=5):
         if (
             datetime.utcnow() - self._last_recent_check
             >= DataHandler.UPDATE_RECENT_FREQUENCY
         ):
-            self._recent_cities = sorted(
-                {
-                    City.from_json(c[0].data)
-                    for c in self._db.session.execute(select(self._table))
-                },
-                key=lambda x: x.timestamp,
-                reverse=True,
-            )[: n * 3]
+            self._recent_pool_size = n * 3
+            rows = (
+                self._db.session.query(self._table.geonameid, self._table.full_name)
+                .order_by(self._table.timestamp.desc())
+                .limit(self._recent_pool_size)
+                .all()
+            )
+            self._recent_cities = [City(*row) for row in rows]
             self._last_recent_check = datetime.utcnow()
-        return sample(self._recent_cities, n)
+        return sample(self._recent_cities, min(n, len(self._recent_cities)))
+
+    def _add_recent_city(self, data):
+        """Keep the recent cities up to date with a city that was just fetched."""
+        recent = [c for c in self._recent_cities if c.geonameid != data.geonameid]
+        recent.insert(0, City(data.geonameid, data.full_name))
+        self._recent_cities = recent[: self._recent_pool_size]
+
+
+_MISSING = object()  # Marks a missing value where None is a valid one.
+
+
+def _same_name(full_name, other):
+    """Whether two "Name, State, Country" names are of cities with the same name;
+    the index also finds similar names, which are likely other cities."""
+    return normalize(full_name.split(",")[0]) == normalize(other.split(",")[0])
+
+
+def _city_size(city):
+    """Approximate the memory used by a decoded city with the size of its json.
+
+    Serializing the city on every cache set to measure it would take longer than
+    most lookups, so this adds up the typical sizes of its parts instead: the
+    nearby cities and living wage tables are what vary between cities.
+    """
+    wages = city.__dict__.get("living_wages")
+    tables = sum(1 for table in wages.values() if table) if isinstance(wages, dict) else 0
+    nearby = city.__dict__.get("nearby_major_cities")
+    return 1350 + 310 * tables + 145 * (len(nearby) if isinstance(nearby, list) else 0)
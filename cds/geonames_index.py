@@ -0,0 +1,175 @@
+"""Local city search index built from a GeoNames dump.
+
+Build it from https://download.geonames.org/export/dump/ (e.g. cities15000.zip
+and admin1CodesASCII.txt) to search cities without calling the geonames API:
+    python geonames_index.py cities15000.txt [--admin1 admin1CodesASCII.txt] [--out FILE]
+"""
+import argparse
+import heapq
+import json
+import os.path
+import threading
+import time
+from collections import Counter
+from os import getenv
+from search_index import normalize, PrefixIndex
+
+# Using a json instead of pickle data because of heroku's storage.
+_index_path = getenv(
+    "CDS_GEONAMES_INDEX",
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), "geonames_index.json"),
+)
+_index = None  # Store the loaded _GeonamesIndex, or False if there's no index file.
+_index_lock = threading.Lock()
+
+
+class _GeonamesIndex(object):
+    def __init__(self, cities):
+        # Each city is [geonameid, name, state, country, population, names, qualifiers].
+        self._cities = cities
+        self._qualifiers = [frozenset(city[6]) for city in cities]
+        self._names = PrefixIndex(
+            (name, i) for i, city in enumerate(cities) for name in set(city[5])
+        )
+        # Trigrams of the main names, for queries with typos.
+        self._trigrams = {}
+        for i, city in enumerate(cities):
+            for trigram in _trigrams(city[5][0]):
+                self._trigrams.setdefault(trigram, []).append(i)
+
+    def search(self, query, max_results):
+        parts = [normalize(part) for part in query.split(",")]
+        name, qualifiers = parts[0], {q for q in parts[1:] if q}
+        if not name:
+            return []
+
+        # Match kind (lower is better): 0 - exact name, 1 - name prefix, 2 - similar name.
+        candidates = {i: 1 for i in self._names.prefix(name)}
+        candidates.update((i, 0) for i in self._names.exact(name))
+        if not candidates:
+            candidates = {i: 2 for i in self._similar(name, max_results * 10)}
+
+        # Cities in the given state/country go first, then the best matches, then the largest.
+        def _rank(i):
+            return (
+                len(qualifiers & self._qualifiers[i]),
+                -candidates[i],
+                self._cities[i][4],
+            )
+
+        best = heapq.nlargest(max_results, candidates, key=_rank)
+        return [(self._cities[i][0], _full_name(self._cities[i])) for i in best]
+
+    def _similar(self, name, n):
+        """Return the n cities whose main name shares the most trigrams with the given name."""
+        query_trigrams = _trigrams(name)
+        shared = Counter()
+        for trigram in query_trigrams:
+            shared.update(self._trigrams.get(trigram, ()))
+        # Keep only reasonably similar names (Jaccard similarity of their trigrams).
+        scores = {}
+        for i, count in shared.items():
+            total = len(query_trigrams) + len(_trigrams(self._cities[i][5][0])) - count
+            if count / total >= 0.3:
+                scores[i] = count / total
+        return heapq.nlargest(n, scores, key=scores.get)
+
+
+def _trigrams(name):
+    padded = f"  {name} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+def _full_name(city):
+    _, name, state, country = city[:4]
+    return f'{name}, {state}{", " if state else ""}{country}'
+
+
+def _load_index():
+    """Load the index into memory, if there's one."""
+    global _index
+    with _index_lock:
+        if _index is not None:
+            return
+        try:
+            with open(_index_path) as file_in:
+                _index = _GeonamesIndex(json.load(file_in)["cities"])
+        except FileNotFoundError:
+            _index = False
+
+
+def available():
+    """Return whether there's a local index to search."""
+    if _index is None:
+        _load_index()
+    return bool(_index)
+
+
+def search(query, max_results=1):
+    """Return a list of (geonameid, "Name, ST, CC") with the best matches for the query."""
+    if not available():
+        raise RuntimeError(f"There's no geonames index at '{_index_path}'.")
+    return _index.search(query, max_results)
+
+
+def build(cities_path, admin1_path=None):
+    """Return the index rows from a GeoNames cities dump (and optionally the admin1 names)."""
+    admin1_names = {}
+    if admin1_path:
+        with open(admin1_path, encoding="utf8") as file_in:
+            for line in file_in:
+                code, name = line.rstrip("\n").split("\t")[:2]
+                admin1_names[code] = normalize(name)
+
+    cities = []
+    with open(cities_path, encoding="utf8") as file_in:
+        for line in file_in:
+            row = line.rstrip("\n").split("\t")
+            geonameid, name, asciiname, alternate_names = row[:4]
+            country, admin1, population = row[8], row[10], row[14]
+            # The API returns the ISO 3166-2 code for the state, which the dump
+            # doesn't have. Alphabetic admin1 codes (e.g. US states) are the same.
+            state = admin1 if admin1.isalpha() else ""
+            names = [normalize(name), normalize(asciiname)] + [
+                normalize(n) for n in alternate_names.split(",") if n
+            ]
+            names = list(dict.fromkeys(n for n in names if n))
+            if not names:
+                continue
+            qualifiers = {normalize(admin1), normalize(country)}
+            if f"{country}.{admin1}" in admin1_names:
+                qualifiers.add(admin1_names[f"{country}.{admin1}"])
+            cities.append(
+                [
+                    int(geonameid),
+                    name,
+                    state,
+                    country,
+                    int(population or 0),
+                    names,
+                    sorted(q for q in qualifiers if q),
+                ]
+            )
+    return cities
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("cities", help="GeoNames cities dump, e.g. cities15000.txt")
+    parser.add_argument("--admin1", help="GeoNames admin1CodesASCII.txt")
+    parser.add_argument("--out", default=_index_path, help="index file to write")
+    args = parser.parse_args()
+
+    cities = build(args.cities, args.admin1)
+    with open(args.out, "w") as file_out:
+        json.dump(
+            {"created": time.strftime("%Y-%m-%d"), "cities": cities},
+            file_out,
+            separators=(",", ":"),
+            ensure_ascii=False,
+        )
+    print(f"Saved {len(cities)} cities to {args.out}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,457 @@
+import logging
+import sqlite3
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from os import getenv
+from urllib.parse import urlsplit
+import requests
+import metrics
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Connect and read timeouts in seconds for every upstream request.
+TIMEOUT = (
+    float(getenv("CDS_HTTP_CONNECT_TIMEOUT", "5")),
+    float(getenv("CDS_HTTP_READ_TIMEOUT", "20")),
+)
+
+# Requests failing with a server error or without an answer are retried this many
+# times, with exponential backoff. Throttling (429) isn't retried: the breaker and
+# the caller's retry_after deal with it, so we don't hammer a host asking us to slow down.
+RETRIES = int(getenv("CDS_HTTP_RETRIES", "3"))
+BACKOFF = float(getenv("CDS_HTTP_BACKOFF", "0.5"))
+_RETRY_STATUSES = (500, 502, 503, 504)
+
+# Max seconds a get() spends on its attempts (timeouts, backoff and the rate limit
+# waits of its retries), so with the first rate limit wait (RATE_LIMIT_MAX_WAIT)
+# it ends before gunicorn's 30s worker timeout. The read timeout is between bytes
+# received, so a body trickling in slowly can still go past it.
+MAX_TIME = float(getenv("CDS_HTTP_MAX_TIME", "15"))
+
+# A single session keeps the connections to each host alive between requests.
+_session = requests.Session()
+_adapter = HTTPAdapter(
+    pool_connections=int(getenv("CDS_HTTP_POOL_HOSTS", "10")),
+    pool_maxsize=int(getenv("CDS_HTTP_POOL_SIZE", "10")),
+)
+_session.mount("http://", _adapter)
+_session.mount("https://", _adapter)
+
+# Number of requests and errors per host.
+_counters = defaultdict(Counter)
+_counters_lock = threading.Lock()
+
+
+_UPSTREAM_SECONDS = metrics.Histogram(
+    "cds_upstream_seconds", "Time of the requests to each upstream host.", ["host"]
+)
+
+
+def _count(host, key):
+    with _counters_lock:
+        _counters[host][key] += 1
+
+
+# Requests to each host are limited with token buckets: a host gets rate tokens
+# per second, up to burst tokens saved, and each request takes one. The buckets
+# are kept in this process, or in a sqlite file shared by every process using it
+# (e.g. all the gunicorn workers) if CDS_RATE_LIMIT_DB is set.
+# Requests that would have to wait longer than max_wait seconds for a token are
+# rejected instead, so a throttled host can't pile up waiting requests.
+RATE_LIMIT_MAX_WAIT = float(getenv("CDS_RATE_LIMIT_MAX_WAIT", "10"))
+
+# Host -> (requests per second, burst, max wait); the None host is the default for all others.
+_rate_limits = {}
+
+
+def set_rate_limit(requests_per_second, host=None, *, burst=1, max_wait=RATE_LIMIT_MAX_WAIT):
+    """Limit the requests to the given host (or to every host) to this many per second,
+    allowing bursts of up to burst requests. None removes the limit; a max_wait of
+    None waits for a token as long as needed."""
+    assert burst >= 1
+    _rate_limits[host] = (
+        (requests_per_second, burst, max_wait) if requests_per_second else None
+    )
+
+
+def _parse_rate_limits(value):
+    """Parse limits like "api.geonames.org=1/5,*=10" into (host, rate, burst);
+    the burst is optional and * is the default for every host."""
+    limits = []
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        host, _, limit = item.partition("=")
+        rate, _, burst = limit.partition("/")
+        host = host.strip()
+        limits.append((None if host == "*" else host, float(rate), int(burst or 1)))
+    return limits
+
+
+def _take_token(state, now, rate, burst, max_wait):
+    """Take a token from a bucket state (tokens, last update), or None if there's none saved.
+
+    Returns the new state and how long to wait for the token (the state's tokens
+    go negative while requests are waiting for them), or (None, None) if that's
+    longer than max_wait.
+    """
+    tokens, updated = state or (burst, now)
+    tokens = min(burst, tokens + (now - updated) * rate)
+    wait = max(0.0, (1 - tokens) / rate)
+    if max_wait is not None and wait > max_wait:
+        return None, None
+    return (tokens - 1, now), wait
+
+
+class _LocalBuckets(object):
+    """Token buckets of this process."""
+
+    def __init__(self):
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def take(self, host, rate, burst, max_wait):
+        with self._lock:
+            state, wait = _take_token(
+                self._buckets.get(host), time.monotonic(), rate, burst, max_wait
+            )
+            if state is not None:
+                self._buckets[host] = state
+        return wait
+
+
+class _SharedBuckets(object):
+    """Token buckets in a sqlite file, shared by all the processes using the same file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()  # sqlite connections can't be shared by threads.
+
+    def _connection(self):
+        connection = getattr(self._local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS buckets "
+                "(host TEXT PRIMARY KEY, tokens REAL NOT NULL, updated REAL NOT NULL)"
+            )
+            self._local.connection = connection
+        return connection
+
+    def take(self, host, rate, burst, max_wait):
+        connection = self._connection()
+        # Lock the file for writing before reading the bucket, so no other
+        # process can take the same token.
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            row = connection.execute(
+                "SELECT tokens, updated FROM buckets WHERE host = ?", (host,)
+            ).fetchone()
+            # Wall clock time, the monotonic clock isn't the same in every process.
+            state, wait = _take_token(row, time.time(), rate, burst, max_wait)
+            if state is not None:
+                connection.execute(
+                    "INSERT OR REPLACE INTO buckets (host, tokens, updated) VALUES (?, ?, ?)",
+                    (host, *state),
+                )
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+        return wait
+
+
+_buckets = (
+    _SharedBuckets(getenv("CDS_RATE_LIMIT_DB"))
+    if getenv("CDS_RATE_LIMIT_DB")
+    else _LocalBuckets()
+)
+for _host, _rate, _burst in _parse_rate_limits(getenv("CDS_RATE_LIMITS", "")):
+    set_rate_limit(_rate, _host, burst=_burst)
+
+
+def _wait_for_turn(host, deadline=None):
+    """Sleep until the host's rate limit allows another request.
+
+    Raises UpstreamUnavailable if that would take longer than the limit's max wait,
+    or than the time left until the deadline (a time.monotonic() value) if given.
+    """
+    limit = _rate_limits.get(host, _rate_limits.get(None))
+    if not limit:
+        return
+    rate, burst, max_wait = limit
+    if deadline is not None:
+        left = max(0.0, deadline - time.monotonic())
+        max_wait = left if max_wait is None else min(max_wait, left)
+    wait = _buckets.take(host or "", rate, burst, max_wait)
+    if wait is None:
+        _count(host, "throttled")
+        raise UpstreamUnavailable(
+            f"Too many requests waiting for {host}.", retry_after=max_wait
+        )
+    time.sleep(wait)
+
+
+# Consecutive failures that open a circuit, and how long it stays open in seconds.
+BREAKER_FAILURES = int(getenv("CDS_BREAKER_FAILURES", "5"))
+BREAKER_COOLDOWN = float(getenv("CDS_BREAKER_COOLDOWN", "60"))
+
+
+class UpstreamError(requests.RequestException):
+    """An upstream service answered with an error instead of the requested data;
+    retry_after is about how many seconds until it's worth trying again, if known."""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class UpstreamUnavailable(UpstreamError):
+    """The request wasn't sent because its upstream is failing or throttled."""
+
+
+class CircuitBreaker(object):
+    """Stop calling a failing upstream for a cooldown after consecutive failures.
+
+    Once the cooldown is over a single call is let through, that closes the
+    circuit again if it succeeds or opens it for another cooldown if it fails.
+    Each process keeps its own breakers.
+    """
+
+    def __init__(self, name, failures=BREAKER_FAILURES, cooldown=BREAKER_COOLDOWN):
+        self.name = name
+        self.failures = failures
+        self.cooldown = cooldown
+        self._failures = 0  # Consecutive failures.
+        self._opened = None  # time.monotonic() when the circuit opened; None if it's closed.
+        self._trial = False  # Whether the call after the cooldown is running.
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self._opened is not None
+
+    def retry_after(self):
+        """Seconds until the cooldown is over, 0 if the circuit is closed."""
+        opened = self._opened
+        if opened is None:
+            return 0
+        return max(0.0, opened + self.cooldown - time.monotonic())
+
+    def allow(self):
+        """Whether to make a call now; each allowed call must end in success(), failure() or cancel()."""
+        with self._lock:
+            if self._opened is None:
+                return True
+            if self._trial or time.monotonic() - self._opened < self.cooldown:
+                return False
+            self._trial = True
+            return True
+
+    def success(self):
+        with self._lock:
+            if self._opened is not None:
+                logger.info(f"{self.name} is working again, closing its circuit.")
+            self._failures = 0
+            self._opened = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._trial or self._failures >= self.failures:
+                if self._opened is None:
+                    logger.warning(
+                        f"{self.name} failed {self._failures} times in a row, "
+                        f"not calling it for {self.cooldown:.0f}s."
+                    )
+                self._opened = time.monotonic()
+            self._trial = False
+
+    def cancel(self):
+        """The allowed call wasn't made."""
+        with self._lock:
+            self._trial = False
+
+    def rejection(self):
+        """Return the exception to raise for a call that wasn't allowed."""
+        retry_after = self.retry_after()
+        return UpstreamUnavailable(
+            f"{self.name} is failing, not calling it for {retry_after:.0f}s.",
+            retry_after=retry_after,
+        )
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def get_breaker(name):
+    """Return the circuit breaker of an upstream host or service."""
+    with _breakers_lock:
+        breaker = _breakers.get(name)
+        if breaker is None:
+            breaker = _breakers[name] = CircuitBreaker(name)
+        return breaker
+
+
+@contextmanager
+def circuit(name):
+    """Run the block unless the named service's circuit is open (raising
+    UpstreamUnavailable), counting any exception in it as a failure."""
+    breaker = get_breaker(name)
+    if not breaker.allow():
+        _count(name, "rejected")
+        raise breaker.rejection()
+    try:
+        yield
+    except Exception:
+        breaker.failure()
+        raise
+    breaker.success()
+
+
+def retry_after(response):
+    """Return the seconds to wait before retrying a failed request, None if unknown.
+
+    Uses the response's Retry-After header (in seconds), or how long the host's
+    circuit stays open.
+    """
+    header = response.headers.get("Retry-After", "")
+    if header.isdecimal():
+        return int(header)
+    host = urlsplit(response.url).hostname
+    return get_breaker(host).retry_after() or None
+
+
+def _is_failure(status_code):
+    """Whether a response means the host is failing or throttling us (and not, e.g., a 404)."""
+    return status_code >= 500 or status_code == 429
+
+
+def _attempt_timeout(timeout, deadline):
+    """Return the (connect, read) timeouts of an attempt, so together they end by the deadline."""
+    connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+    left = max(0.1, deadline - time.monotonic())
+    connect = min(connect, left)
+    return connect, max(0.1, min(read, left - connect))
+
+
+def _send(host, url, timeout, kwargs):
+    """Send the request, retrying server errors and failed connections until the deadline.
+
+    Returns the last response, or raises the last error, once it can't retry anymore.
+    """
+    deadline = time.monotonic() + MAX_TIME
+    for attempt in range(RETRIES + 1):
+        _count(host, "requests")
+        try:
+            with _UPSTREAM_SECONDS.time(host):
+                response = _session.get(
+                    url, timeout=_attempt_timeout(timeout, deadline), **kwargs
+                )
+        except (requests.ConnectionError, requests.Timeout) as e:
+            _count(host, "errors")
+            response, error = None, e
+        else:
+            if response.status_code not in _RETRY_STATUSES:
+                return response
+            _count(host, "errors")
+            error = None
+        backoff = BACKOFF * 2**attempt
+        if attempt == RETRIES or time.monotonic() + backoff >= deadline:
+            break
+        logger.info(f"Retrying a request to {host} in {backoff:.1f}s.")
+        time.sleep(backoff)
+        # Each retry takes its own rate limit token, the limiter must see every request.
+        try:
+            _wait_for_turn(host, deadline)
+        except UpstreamUnavailable:
+            break
+    if error is not None:
+        raise error
+    return response
+
+
+def get(url, *, is_error=None, **kwargs):
+    """Send a GET request through the shared session, with the default timeouts.
+
+    Server errors and failed connections are retried, for at most MAX_TIME seconds.
+    Raises UpstreamUnavailable without sending it if the host's circuit is open
+    or if it's throttled for too long by its rate limit. is_error is an optional
+    function telling if a successful response is actually an error, for APIs
+    that answer errors with a 200.
+    """
+    timeout = kwargs.pop("timeout", TIMEOUT)
+    host = urlsplit(url).hostname
+    breaker = get_breaker(host)
+    if not breaker.allow():
+        _count(host, "rejected")
+        raise breaker.rejection()
+    try:
+        _wait_for_turn(host)
+    except UpstreamUnavailable:
+        breaker.cancel()
+        raise
+    try:
+        response = _send(host, url, timeout, kwargs)
+    except requests.RequestException:
+        breaker.failure()
+        raise
+    if response.status_code >= 400:
+        if response.status_code not in _RETRY_STATUSES:  # Those are counted by each attempt.
+            _count(host, "errors")
+    elif is_error and is_error(response):
+        _count(host, "errors")
+        breaker.failure()
+        return response
+    if _is_failure(response.status_code):
+        breaker.failure()
+    else:
+        breaker.success()
+    return response
+
+
+def request_counts():
+    """Return a snapshot of the number of requests and errors per host."""
+    with _counters_lock:
+        return {host: dict(counter) for host, counter in _counters.items()}
+
+
+# Key in the request counts and description of each exported counter.
+_COUNT_METRICS = (
+    ("requests", "Upstream requests by host."),
+    ("errors", "Upstream requests that failed or answered with an error, by host."),
+    ("rejected", "Calls not made because the host's circuit was open."),
+    ("throttled", "Requests not sent because they'd wait too long for the rate limit."),
+)
+
+
+def _collect_counts():
+    counts = request_counts()
+    families = [
+        (
+            f"cds_upstream_{key}_total",
+            "counter",
+            description,
+            [({"host": host}, counter.get(key, 0)) for host, counter in counts.items()],
+        )
+        for key, description in _COUNT_METRICS
+    ]
+    with _breakers_lock:
+        breakers = list(_breakers.values())
+    families.append(
+        (
+            "cds_circuit_open",
+            "gauge",
+            "Whether calls to the host are stopped by its circuit breaker.",
+            [({"host": b.name}, int(b.is_open)) for b in breakers],
+        )
+    )
+    return families
+
+
+metrics.register_collector(_collect_counts)
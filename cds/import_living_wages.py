@@ -0,0 +1,129 @@
+"""Build the living wages snapshot used by living_wages.get_wages.
+
+Crawls every state, metro and county page from livingwage.mit.edu once (or
+reads them from a directory saved by a previous crawl) and stores the parsed
+wages in a json file, so US cities don't need any live scraping.
+
+Usage:
+    python import_living_wages.py [--from-html DIR] [--save-html DIR] [--out FILE]
+"""
+import argparse
+import json
+import os.path
+import time
+from urllib.parse import quote
+import requests
+from bs4 import BeautifulSoup
+import http_client
+import living_wages
+
+
+def _html_filename(html_dir, path):
+    return os.path.join(html_dir, (quote(path, safe="") or "index") + ".html")
+
+
+def _page_getter(from_html=None, save_html=None, delay=0.0, retries=3):
+    """Return a function that loads a page path from the website or a saved directory."""
+
+    def _download(path):
+        for attempt in range(retries + 1):
+            time.sleep(delay)  # Be nice to the website.
+            try:
+                page = http_client.get(living_wages.base_url + path)
+                page.raise_for_status()
+                return page.text
+            except requests.RequestException as e:
+                if attempt == retries:
+                    raise
+                wait = getattr(e, "retry_after", None) or delay * 2 ** (attempt + 2)
+                print(f"\tRetrying '{path}' in {wait:.0f}s: {e!r}")
+                time.sleep(wait)
+
+    def _get_page(path):
+        if from_html:
+            with open(_html_filename(from_html, path), encoding="utf8") as file_in:
+                text = file_in.read()
+        else:
+            text = _download(path)
+            if save_html:
+                with open(_html_filename(save_html, path), "w", encoding="utf8") as f:
+                    f.write(text)
+        return BeautifulSoup(text, "lxml")
+
+    return _get_page
+
+
+def build_snapshot(get_page, states=None):
+    """Return dict(state name -> dict(metros, counties, state)) with all the parsed wages.
+
+    Pages that couldn't be loaded or parsed are left out (and so is a state
+    without its locations page), living_wages.get_wages looks those up live.
+    """
+
+    def _parse_wages(path):
+        if not path:
+            return None
+        try:
+            return living_wages._parse_wages(get_page(path))
+        except (OSError, requests.RequestException, IndexError, AttributeError) as e:
+            print(f"\tCouldn't parse the wages in '{path}': {e!r}")
+            return None
+
+    def _parse_all(links):
+        parsed = [[name, _parse_wages(path)] for name, path in links]
+        return [[name, wages] for name, wages in parsed if wages is not None]
+
+    snapshot = {}
+    state_paths = living_wages._parse_state_paths(get_page(""))
+    for state_name, locations_path in state_paths.items():
+        if not locations_path.endswith("/locations"):
+            continue  # Not a link to a state.
+        if states and state_name not in states:
+            continue
+        print(f"Importing {state_name}...")
+        try:
+            locations = living_wages._parse_state_locations(get_page(locations_path))
+        except (OSError, requests.RequestException, IndexError) as e:
+            print(f"\tCouldn't parse the locations of {state_name}: {e!r}")
+            continue
+        snapshot[state_name] = {
+            "metros": _parse_all(locations["metros"]),
+            "counties": _parse_all(locations["counties"]),
+        }
+        state_wages = _parse_wages(locations["state"])
+        if state_wages is not None:
+            snapshot[state_name]["state"] = state_wages
+    return snapshot
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--from-html", help="read the pages saved by --save-html")
+    parser.add_argument("--save-html", help="save the downloaded pages to this dir")
+    parser.add_argument(
+        "--out", default=living_wages._snapshot_path, help="snapshot file to write"
+    )
+    parser.add_argument(
+        "--delay", type=float, default=0.5, help="seconds to wait between requests"
+    )
+    parser.add_argument(
+        "--state", action="append", help="only import this state (full name)"
+    )
+    args = parser.parse_args()
+
+    if args.save_html:
+        os.makedirs(args.save_html, exist_ok=True)
+    get_page = _page_getter(args.from_html, args.save_html, args.delay)
+    snapshot = build_snapshot(get_page, args.state)
+
+    with open(args.out, "w") as file_out:
+        json.dump(
+            {"created": time.strftime("%Y-%m-%d"), "states": snapshot},
+            file_out,
+            separators=(",", ":"),
+        )
+    print(f"Saved the wages of {len(snapshot)} states to {args.out}.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,147 @@
 import os.path
 import json
-from heapq import heappush, heappushpop
-from geopy.distance import distance
+import numpy as np
 
-_data = None  # Store the large cities as a dict(coordinates -> name, pop).
+_data = None  # Store the large cities as a list of dict(name, coordinates, population).
+_lat = None  # Latitudes in degrees, aligned with _data.
+_lon = None  # Longitudes in degrees, aligned with _data.
+_unique = None  # Mask of the first occurrence of each repeated entry in _data.
+
+# Spatial index: positions in _data sorted by latitude, and the sorted latitudes.
+# Any city within d km of a point is at most d / _KM_PER_LAT_DEGREE degrees of
+# latitude away from it, so a query only needs to look at a latitude band.
+_by_lat = None
+_sorted_lat = None
+_KM_PER_LAT_DEGREE = 110.5  # slightly below the shortest degree (110.574km at the equator)
+
+# Initial search radius in km for the k closest cities; doubled until k are found.
+_K_CLOSEST_START_RADIUS = 500
+
+# WGS-84 ellipsoid, the same one used by geopy's default geodesic distance.
+_EARTH_A = 6378.137  # semi-major axis in km
+_EARTH_F = 1 / 298.257223563  # flattening
 
 
 def _load_data():
     """Load the preprocessed data into memory."""
-    global _data
+    global _data, _lat, _lon, _unique, _by_lat, _sorted_lat
     if _data:
         return
     # Using a json instead of pickle data because of heroku's storage.
     root_dir = os.path.dirname(os.path.realpath(__file__))
     filepath = os.path.join(root_dir, "large_cities.json")
     with open(filepath) as file_in:
-        _data = json.load(file_in)
-    for city in _data:
+        data = json.load(file_in)
+    for city in data:
         city["coordinates"] = tuple(city["coordinates"])
 
+    # Keep the coordinates in contiguous arrays so distances can be computed in batch.
+    coordinates = np.array([city["coordinates"] for city in data], dtype=np.float64)
+    _lat = np.ascontiguousarray(coordinates[:, 0])
+    _lon = np.ascontiguousarray(coordinates[:, 1])
+
+    seen = set()
+    _unique = np.zeros(len(data), dtype=bool)
+    for i, city in enumerate(data):
+        key = tuple(city.items())
+        if key not in seen:
+            seen.add(key)
+            _unique[i] = True
+
+    _by_lat = np.argsort(_lat, kind="stable")
+    _sorted_lat = _lat[_by_lat]
+
+    _data = data
+
+
+def _candidates(coordinates, radius):
+    """Return the indices of the cities that might be within the given radius in km."""
+    lat_range = radius / _KM_PER_LAT_DEGREE
+    lo = np.searchsorted(_sorted_lat, coordinates[0] - lat_range, side="left")
+    hi = np.searchsorted(_sorted_lat, coordinates[0] + lat_range, side="right")
+    return _by_lat[lo:hi]
+
+
+def _distances(coordinates, idx):
+    """Return the distances in km from the given coordinates to the large cities in idx.
+
+    Uses Lambert's formula for long lines on the WGS-84 ellipsoid, which agrees
+    with geopy's geodesic distance within 10m up to 5,000km and within 0.01%
+    (~2km) for nearly antipodal points.
+    The city located exactly at the given coordinates gets an infinite distance
+    so it's never included in the results.
+    """
+    lat0, lon0 = coordinates
+    lat, lon = _lat[idx], _lon[idx]
+
+    # Reduced latitudes.
+    beta1 = np.arctan((1 - _EARTH_F) * np.tan(np.radians(lat0)))
+    beta2 = np.arctan((1 - _EARTH_F) * np.tan(np.radians(lat)))
+
+    # Central angle between the reduced latitudes (haversine).
+    dlon = np.radians(lon - lon0)
+    hav = (
+        np.sin((beta2 - beta1) / 2) ** 2
+        + np.cos(beta1) * np.cos(beta2) * np.sin(dlon / 2) ** 2
+    )
+    sigma = 2 * np.arcsin(np.sqrt(np.clip(hav, 0, 1)))
+
+    # Lambert's correction for the flattening.
+    p = (beta1 + beta2) / 2
+    q = (beta2 - beta1) / 2
+    with np.errstate(divide="ignore", invalid="ignore"):
+        x = (sigma - np.sin(sigma)) * (
+            np.sin(p) ** 2 * np.cos(q) ** 2 / np.cos(sigma / 2) ** 2
+        )
+        y = (sigma + np.sin(sigma)) * (
+            np.cos(p) ** 2 * np.sin(q) ** 2 / np.sin(sigma / 2) ** 2
+        )
+        dist = _EARTH_A * (sigma - _EARTH_F / 2 * (x + y))
+    # Coincident points make the correction 0/0.
+    dist[sigma == 0] = 0.0
+
+    # We don't want to include the city itself here.
+    dist[(lat == lat0) & (lon == lon0)] = np.inf
+    return dist
+
+
+def _k_closest(coordinates, k):
+    """Return the indices of the k closest cities and their distances, sorted by distance."""
+    radius = _K_CLOSEST_START_RADIUS
+    while True:
+        idx = _candidates(coordinates, radius)
+        dist = _distances(coordinates, idx)
+        # The band has every city within the radius, so if k of them are inside
+        # the radius they are the k closest overall.
+        if np.count_nonzero(dist <= radius) >= k or len(idx) == len(_data):
+            break
+        radius *= 2
+
+    k = min(k, int(np.isfinite(dist).sum()))
+    if k <= 0:
+        return idx[:0], dist[:0]
+    top = np.argpartition(dist, k - 1)[:k]
+    top = top[np.argsort(dist[top], kind="stable")]
+    return idx[top], dist[top]
+
+
+def _within_radius(coordinates, radius):
+    """Return the indices of the unique cities within the given radius in km and their distances."""
+    idx = _candidates(coordinates, radius)
+    dist = _distances(coordinates, idx)
+    mask = (dist <= radius) & _unique[idx]
+    return idx[mask], dist[mask]
+
+
+def _with_distances(idx, dist):
+    """Return copies of the large cities in idx including their distances."""
+    result = []
+    for i, d in zip(idx, dist):
+        city = _data[i].copy()
+        city["distance"] = float(d)
+        result.append(city)
+    return result
+
 
 def find_k_closest_large_cities(coordinates, k=3):
     """Return a sorted list the k closest large cities for the given coordinates."""
@@ -29,26 +152,7 @@ def find_k_closest_large_cities(coordinates, k=3):
     if _data is None:
         _load_data()
 
-    # Initialize counter and result list.
-    result = []
-
-    for city in _data:
-        city_copy = city.copy()
-
-        # We don't want to include the city itself here.
-        if city_copy["coordinates"] == coordinates:
-            continue
-
-        # Calculate the distance.
-        city_copy["distance"] = distance(city_copy["coordinates"], coordinates).km
-
-        # Populate the list of k closest ones as a heap.
-        if len(result) < k:
-            heappush(result, (-city_copy["distance"], city_copy))
-        else:
-            heappushpop(result, (-city_copy["distance"], city_copy))
-
-    return [city for _, city in sorted(result, reverse=True)]
+    return _with_distances(*_k_closest(coordinates, k))
 
 
 def find_all_large_cities_within_radius(coordinates, radius=250):
@@ -57,26 +161,7 @@ def find_all_large_cities_within_radius(coordinates, radius=250):
     if _data is None:
         _load_data()
 
-    result = set()
-
-    for city in _data:
-        city_copy = city.copy()
-
-        # We don't want to include the city itself here.
-        if city_copy["coordinates"] == coordinates:
-            continue
-
-        # Calculate the distance.
-        city_copy["distance"] = distance(city["coordinates"], coordinates).km
-
-        # Skip cities further than the given radius.
-        if city_copy["distance"] > radius:
-            continue
-
-        # Add current city to the result set.
-        result.add(tuple(city_copy.items()))
-
-    return [{x[0]: x[1] for x in city} for city in result]
+    return _with_distances(*_within_radius(coordinates, radius))
 
 
 def find_both_k_closest_and_radius(coordinates, k=3, radius=250):
@@ -89,32 +174,18 @@ def find_both_k_closest_and_radius(coordinates, k=3, radius=250):
     if _data is None:
         _load_data()
 
-    within_radius = set()
-    closest = []
-
-    for city in _data:
-        city_copy = city.copy()
-
-        # We don't want to include the city itself here.
-        if city["coordinates"] == coordinates:
-            continue
-
-        # Calculate the distance.
-        city_copy["distance"] = distance(city["coordinates"], coordinates).km
+    within_radius = _with_distances(*_within_radius(coordinates, radius))
+    closest = _with_distances(*_k_closest(coordinates, k))
+    return within_radius, closest
 
-        # Update the k-closest cities.
-        if len(closest) < k:
-            heappush(closest, (-city_copy["distance"], city_copy))
-        else:
-            heappushpop(closest, (-city_copy["distance"], city_copy))
 
-        # Add the city to the result set if it's within the radius.
-        if city_copy["distance"] <= radius:
-            within_radius.add(tuple(city_copy.items()))
+def get_all_large_cities():
+    """Return a list with all unique large cities."""
+    # Load data if it hasn't been loaded yet.
+    if _data is None:
+        _load_data()
 
-    within_radius = [{x[0]: x[1] for x in city} for city in within_radius]
-    closest = [city for _, city in sorted(closest, reverse=True)]
-    return within_radius, closest
+    return [city.copy() for city, unique in zip(_data, _unique) if unique]
 
 
 if __name__ == "__main__":
@@ -1,127 +1,216 @@
-import requests
+import os.path
+import json
+import http_client
+import metrics
 import utils
 from bs4 import BeautifulSoup
+from cache import TTLCache
+from datetime import timedelta
+from os import getenv
 import itertools
 
 # Living Wage start page URL.
 base_url = "https://livingwage.mit.edu"
 
+# The living wage data is updated about once a year and it's the same for every
+# city in a state, so the parsed pages are cached (and saved to CDS_CACHE_DIR if set).
+_CACHE_TTL = timedelta(days=30)
+_cache_dir = getenv("CDS_CACHE_DIR", "")
+
+
+def _cache_path(filename):
+    return os.path.join(_cache_dir, filename) if _cache_dir else None
+
+
+# Offline copy of every state's wages, see import_living_wages.py.
+# Using a json instead of pickle data because of heroku's storage.
+_snapshot_path = getenv(
+    "CDS_LIVING_WAGES_SNAPSHOT",
+    os.path.join(os.path.dirname(os.path.realpath(__file__)), "living_wages.json"),
+)
+_snapshot = None  # Store the snapshot as dict(state name -> dict(metros, counties, state)).
+
+# Homepage url -> dict(state name -> locations page path).
+_state_paths = TTLCache(
+    maxsize=1, ttl=_CACHE_TTL, path=_cache_path("living_wage_states.json")
+)
+# Locations page path -> dict(metros, counties, state) with the links to each page.
+_state_locations = TTLCache(
+    maxsize=100, ttl=_CACHE_TTL, path=_cache_path("living_wage_locations.json")
+)
+# Page path -> parsed wages for that page.
+_wage_tables = TTLCache(
+    maxsize=5000, ttl=_CACHE_TTL, path=_cache_path("living_wage_tables.json")
+)
+metrics.register_cache("living_wage_tables", _wage_tables)
+
+
+def _get_page(path):
+    """Download and parse a page from the living wage website."""
+    page = http_client.get(base_url + path)
+    # Don't parse (and cache) an error page.
+    page.raise_for_status()
+    return BeautifulSoup(page.text, "lxml")
+
+
+def _load_snapshot():
+    """Load the living wages snapshot into memory, if there's one."""
+    global _snapshot
+    if _snapshot is not None:
+        return
+    try:
+        with open(_snapshot_path) as file_in:
+            _snapshot = json.load(file_in)["states"]
+    except FileNotFoundError:
+        _snapshot = {}
+
+
+def _get_state_paths():
+    """Return a dict(state name -> locations page path) from the homepage."""
+    state_paths = _state_paths.get(base_url)
+    if state_paths is None:
+        state_paths = _parse_state_paths(_get_page(""))
+        # A page without any state isn't the homepage we know (e.g., maintenance), don't keep it.
+        if not state_paths:
+            raise ValueError("Couldn't find any state in the living wage homepage.")
+        _state_paths.set(base_url, state_paths)
+    return state_paths
+
+
+def _parse_state_paths(homepage):
+    state_paths = {}
+    for item in homepage.find_all("li"):
+        if item.a is not None:
+            state_paths.setdefault(item.text.strip(), item.a["href"])
+    return state_paths
+
+
+def _get_state_locations(state):
+    """Return the links to the metro, county and state pages for the given state."""
+    state_name = utils.state_province_to_long(state)
+    locations_path = _get_state_paths().get(state_name, "")
+    if not locations_path:
+        raise ValueError(f"Couldn't find a page for state '{state}' ({state_name}).")
+
+    state_locations = _state_locations.get(locations_path)
+    if state_locations is None:
+        state_locations = _parse_state_locations(_get_page(locations_path))
+        _state_locations.set(locations_path, state_locations)
+    return state_locations
+
+
+def _parse_state_locations(page):
+    def _parse_links(div_class):
+        div = page.find_all("div", {"class": div_class})[0]
+        return [[li.text.strip(), li.a["href"]] for li in div.find_all("li")]
+
+    lookup_text_start = "Show results for "
+    lookup_text_end = " as a whole"
+    state_path = ""
+    for a in page.find_all("a"):
+        atext = a.text.strip()
+        if atext.startswith(lookup_text_start) and atext.endswith(lookup_text_end):
+            state_path = a["href"]
+            break
+
+    return {
+        "metros": _parse_links("metros list-unstyled"),
+        "counties": _parse_links("counties list-unstyled"),
+        "state": state_path,
+    }
+
+
+def _find_metro(state_locations, city):
+    """Return the link (or wages) of the first metro area that includes the city name."""
+    lower_city = city.lower()
+    aux_city = (
+        lower_city if not lower_city.endswith(" city") else lower_city[: -len(" city")]
+    )
+    for metro_name, metro in state_locations["metros"]:
+        metro_name = metro_name.lower()
+        if lower_city in metro_name or aux_city in metro_name:
+            return metro
+    return None
+
+
+def _find_county(state_locations, county):
+    """Return the link (or wages) of the county with the given name."""
+    county_name = county.lower()
+    county_name = (
+        county_name if county_name.endswith(" county") else (county_name + " county")
+    )
+    for _county, county_data in state_locations["counties"]:
+        if county_name == _county.lower():
+            return county_data
+    return None
+
+
+def _get_wages_table(path):
+    """Return the parsed wages in the given page path, None if there's no page."""
+    if not path:
+        return None
+    wages = _wage_tables.get(path)
+    if wages is None:
+        wages = _parse_wages(_get_page(path))
+        _wage_tables.set(path, wages)
+    return wages
+
+
+def _parse_wages(page):
+    result = {}
+
+    # Find the place's name.
+    first_div = page.find("div", {"class": "container"})
+    header_text = first_div.find("h1").text
+    name = header_text[len("Living Wage Calculation for ") :]
+    if "," in name:
+        name = name[: name.rfind(",")]
+    result["name"] = name
+
+    # Find the wages.
+    table = page.find_all("table", {"class": "expense_table"})[0]
+    result_row = table.find_all("tr", {"class": "results"})[0]
+    wages = [r.text.strip() for r in result_row if r.text.strip().startswith("$")]
+
+    adults = ["1A1W", "2A1W", "2W2W"]
+    children = ["0C", "1C", "2C", "3C"]
+    result["wages"] = {}
+    for (a, c), wage in zip(itertools.product(adults, children), wages):
+        key = f"{a}{c}"
+        result["wages"][key] = wage
+
+    return result
+
 
 def get_wages(state, city, county):
-    def _find_state_locations():
-        page = requests.get(base_url)
-        soup = BeautifulSoup(page.text, "lxml")
-
-        state_name = utils.state_province_to_long(state)
-        locations_path = ""
-        for item in soup.find_all("li"):
-            if state_name == item.text.strip():
-                locations_path = item.a["href"]
-                break
-
-        if not locations_path:
-            raise ValueError(
-                f"Couldn't find a page for state '{state}' ({state_name})."
-            )
-
-        state_locations = requests.get(base_url + locations_path)
-        return BeautifulSoup(state_locations.text, "lxml")
-
-    def _find_metro_page(state_locations):
-        metro_class = "metros list-unstyled"
-        div = state_locations.find_all("div", {"class": metro_class})[0]
-        metro_path = ""
-        lower_city = city.lower()
-        aux_city = (
-            lower_city
-            if not lower_city.endswith(" city")
-            else lower_city[: -len(" city")]
-        )
-        for metro in div.find_all("li"):
-            metro_name = metro.text.strip().lower()
-            if lower_city in metro_name or aux_city in metro_name:
-                metro_path = metro.a["href"]
-                break
-
-        if not metro_path:
-            return None
-
-        metro_page = requests.get(base_url + metro_path)
-        return BeautifulSoup(metro_page.text, "lxml")
-
-    def _find_county_page(state_locations):
-        county_class = "counties list-unstyled"
-        div = state_locations.find_all("div", {"class": county_class})[0]
-        county_path = ""
-        county_name = county.lower()
-        county_name = (
-            county_name
-            if county_name.endswith(" county")
-            else (county_name + " county")
-        )
-        for _county in div.find_all("li"):
-            if county_name == _county.text.strip().lower():
-                county_path = _county.a["href"]
-                break
-
-        if not county_path:
-            return None
-
-        county_page = requests.get(base_url + county_path)
-        return BeautifulSoup(county_page.text, "lxml")
-
-    def _find_state_page(state_locations):
-        lookup_text_start = "Show results for "
-        lookup_text_end = " as a whole"
-        state_path = ""
-        for a in state_locations.find_all("a"):
-            atext = a.text.strip()
-            if atext.startswith(lookup_text_start) and atext.endswith(lookup_text_end):
-                state_path = a["href"]
-                break
-
-        if not state_path:
-            return None
-
-        state_page = requests.get(base_url + state_path)
-        return BeautifulSoup(state_page.text, "lxml")
-
-    def _parse_wages(page):
-        if not page:
-            return None
-
-        result = {}
-
-        # Find the place's name.
-        first_div = page.find("div", {"class": "container"})
-        header_text = first_div.find("h1").text
-        name = header_text[len("Living Wage Calculation for ") :]
-        if "," in name:
-            name = name[: name.rfind(",")]
-        result["name"] = name
-
-        # Find the wages.
-        table = page.find_all("table", {"class": "expense_table"})[0]
-        result_row = table.find_all("tr", {"class": "results"})[0]
-        wages = [r.text.strip() for r in result_row if r.text.strip().startswith("$")]
-
-        adults = ["1A1W", "2A1W", "2W2W"]
-        children = ["0C", "1C", "2C", "3C"]
-        result["wages"] = {}
-        for (a, c), wage in zip(itertools.product(adults, children), wages):
-            key = f"{a}{c}"
-            result["wages"][key] = wage
-
-        return result
-
-    state_locations = _find_state_locations()
-    metro_page = _find_metro_page(state_locations)
-    county_page = _find_county_page(state_locations)
-    state_page = _find_state_page(state_locations)
+    # Answer from the snapshot when we have one for this state.
+    if _snapshot is None:
+        _load_snapshot()
+    state_wages = _snapshot.get(utils.state_province_to_long(state))
+    if state_wages is not None:
+        wages = {
+            "metro": _find_metro(state_wages, city),
+            "county": _find_county(state_wages, county),
+            "state": state_wages.get("state"),
+        }
+        if all(wages.values()):
+            return wages
+        # The snapshot leaves out the pages it couldn't import, look for them live.
+        # (This also checks the cities that aren't in any metro or county, but
+        # the locations page is cached.)
+        state_locations = _get_state_locations(state)
+        live = {
+            "metro": lambda: _find_metro(state_locations, city),
+            "county": lambda: _find_county(state_locations, county),
+            "state": lambda: state_locations["state"],
+        }
+        return {k: v or _get_wages_table(live[k]()) for k, v in wages.items()}
+
+    state_locations = _get_state_locations(state)
     return {
-        "metro": _parse_wages(metro_page),
-        "county": _parse_wages(county_page),
-        "state": _parse_wages(state_page),
+        "metro": _get_wages_table(_find_metro(state_locations, city)),
+        "county": _get_wages_table(_find_county(state_locations, county)),
+        "state": _get_wages_table(state_locations["state"]),
     }
 
 
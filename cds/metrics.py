@@ -0,0 +1,176 @@
+"""Latency histograms and counters, rendered in the Prometheus text format.
+
+Each process keeps its own metrics, so with several gunicorn workers every
+scrape of /metrics only sees the worker that answered it.
+"""
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the latency buckets.
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+_metrics = []  # Histograms and counters, in the order they were created.
+_collectors = []  # Functions returning metrics computed on each scrape.
+# Durations by name of the current request's thread, for the Server-Timing header.
+_request = threading.local()
+
+
+class Histogram(object):
+    """Count of observed values in each bucket, with their sum, for each combination of labels.
+
+    If a timing name is given, the durations measured by time() in a request's
+    thread are also added to its Server-Timing header.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, description, labels=(), *, timing=None, buckets=BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.timing = timing
+        self.buckets = tuple(buckets) + (math.inf,)
+        self._values = {}  # label values -> [count per bucket..., sum]
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def observe(self, value, *label_values):
+        assert len(label_values) == len(self.labels)
+        with self._lock:
+            values = self._values.get(label_values)
+            if values is None:
+                values = self._values[label_values] = [0] * len(self.buckets) + [0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    values[i] += 1
+                    break
+            values[-1] += value
+
+    @contextmanager
+    def time(self, *label_values):
+        """Observe how long the block takes, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe(elapsed, *label_values)
+            if self.timing:
+                add_request_timing("-".join((self.timing,) + label_values), elapsed)
+
+    def samples(self):
+        with self._lock:
+            values = {labels: list(counts) for labels, counts in self._values.items()}
+        for label_values, counts in values.items():
+            labels = dict(zip(self.labels, label_values))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = "+Inf" if bound == math.inf else f"{bound}"
+                yield f"{self.name}_bucket", {**labels, "le": le}, cumulative
+            yield f"{self.name}_sum", labels, counts[-1]
+            yield f"{self.name}_count", labels, cumulative
+
+
+class Counter(object):
+    """Total for each combination of labels."""
+
+    type = "counter"
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        _metrics.append(self)
+
+    def inc(self, *label_values, amount=1):
+        assert len(label_values) == len(self.labels)
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for label_values, value in values.items():
+            yield self.name, dict(zip(self.labels, label_values)), value
+
+
+def register_collector(collect):
+    """Add a function called on each scrape, that returns a list of
+    (name, type, description, [(labels dict, value), ...])."""
+    _collectors.append(collect)
+
+
+# Metric name, type, description and TTLCache.stats() key of the cache metrics.
+_CACHE_METRICS = (
+    ("cds_cache_hits_total", "counter", "Cache hits.", "hits"),
+    ("cds_cache_misses_total", "counter", "Cache misses.", "misses"),
+    ("cds_cache_evictions_total", "counter", "Entries evicted to make room.", "evictions"),
+    ("cds_cache_entries", "gauge", "Entries in the cache.", "size"),
+    ("cds_cache_bytes", "gauge", "Approximate size of the cached values.", "bytes"),
+)
+
+
+def register_cache(name, cache):
+    """Export the size and the hit/miss/eviction counters of a TTLCache."""
+
+    def collect():
+        stats = cache.stats()
+        return [
+            (metric, kind, description, [({"cache": name}, stats[key])])
+            for metric, kind, description, key in _CACHE_METRICS
+        ]
+
+    register_collector(collect)
+
+
+def render():
+    """Return all the metrics in the Prometheus text format."""
+    families = {}  # name -> (type, description, samples)
+    for metric in _metrics:
+        families[metric.name] = (metric.type, metric.description, list(metric.samples()))
+    for collect in _collectors:
+        for name, kind, description, samples in collect():
+            family = families.setdefault(name, (kind, description, []))
+            family[2].extend((name, labels, value) for labels, value in samples)
+
+    lines = []
+    for name, (kind, description, samples) in families.items():
+        lines.append(f"# HELP {name} {description}")
+        lines.append(f"# TYPE {name} {kind}")
+        for sample_name, labels, value in samples:
+            lines.append(f"{sample_name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in labels.items()
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def start_request_timings():
+    """Start collecting the durations measured in this thread for the Server-Timing header."""
+    _request.timings = {}
+
+
+def add_request_timing(name, seconds):
+    """Add a duration to the current request's Server-Timing header, if it's being collected."""
+    timings = getattr(_request, "timings", None)
+    if timings is not None:
+        timings[name] = timings.get(name, 0) + seconds
+
+
+def pop_request_timings():
+    """Return the Server-Timing header value for the durations collected in this thread."""
+    timings = getattr(_request, "timings", None) or {}
+    _request.timings = None
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
@@ -0,0 +1,63 @@
+import logging
+import threading
+import time
+from collections import Counter
+
+logger = logging.getLogger(__name__)
+
+
+class RefreshQueue(object):
+    """Refresh stale cities in a background thread, the most requested ones first.
+
+    Refreshes are spaced by at least min_interval seconds, so a burst of stale
+    cities doesn't hammer the upstream sources.
+    """
+
+    def __init__(self, app, handler, *, older_than, min_interval=10, max_queued=1000):
+        self._app = app
+        self._handler = handler
+        self._older_than = older_than
+        self._min_interval = min_interval
+        self._max_queued = max_queued
+        # Number of times each queued city was requested, used as its priority.
+        self._queued = Counter()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def enqueue(self, geonameid):
+        """Schedule a refresh of the given city; returns whether it's queued."""
+        with self._cond:
+            if geonameid not in self._queued and len(self._queued) >= self._max_queued:
+                return False
+            self._queued[geonameid] += 1
+            self._cond.notify()
+            # Start the thread on first use, since gunicorn forks the workers after importing the app.
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="city-refresher", daemon=True
+                )
+                self._thread.start()
+        return True
+
+    def __len__(self):
+        return len(self._queued)
+
+    def _next(self):
+        """Wait for and remove the most requested city in the queue."""
+        with self._cond:
+            while not self._queued:
+                self._cond.wait()
+            geonameid, _ = self._queued.most_common(1)[0]
+            del self._queued[geonameid]
+            return geonameid
+
+    def _run(self):
+        while True:
+            geonameid = self._next()
+            start = time.monotonic()
+            try:
+                with self._app.app_context():
+                    self._handler.refresh_city(geonameid, older_than=self._older_than)
+            except Exception:
+                logger.exception(f"Couldn't refresh city {geonameid}.")
+            time.sleep(max(self._min_interval - (time.monotonic() - start), 0))
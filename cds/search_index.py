@@ -0,0 +1,45 @@
+import bisect
+import re
+import unicodedata
+
+_SEPARATORS_RE = re.compile(r"[\W_]+")
+
+
+def normalize(text):
+    """Fold the case, diacritics, punctuation and whitespace of a name for lookups.
+    E.g., " São  Tomé-e-Príncipe " -> "sao tome e principe"."""
+    text = unicodedata.normalize("NFKD", text)
+    text = "".join(c for c in text if not unicodedata.combining(c)).casefold()
+    return _SEPARATORS_RE.sub(" ", text).strip()
+
+
+class PrefixIndex(object):
+    """Sorted array of (key, id) pairs to find all ids whose key starts with a prefix."""
+
+    def __init__(self, items=()):
+        self._items = sorted(items)
+
+    def add(self, key, id):
+        """Add a key, keeping the array sorted; ids must be comparable (e.g., ints)."""
+        bisect.insort(self._items, (key, id))
+
+    def remove(self, key, id):
+        """Remove a key added with the given id, if it's there."""
+        i = bisect.bisect_left(self._items, (key, id))
+        if i < len(self._items) and self._items[i] == (key, id):
+            del self._items[i]
+
+    def __len__(self):
+        return len(self._items)
+
+    def exact(self, key):
+        """Return the ids of the given key."""
+        lo = bisect.bisect_left(self._items, (key,))
+        hi = bisect.bisect_left(self._items, (key + "\0",))
+        return [id for _, id in self._items[lo:hi]]
+
+    def prefix(self, prefix):
+        """Return the ids of all keys that start with the given prefix."""
+        lo = bisect.bisect_left(self._items, (prefix,))
+        hi = bisect.bisect_left(self._items, (prefix + "\U0010ffff",))
+        return [id for _, id in self._items[lo:hi]]
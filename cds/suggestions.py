@@ -0,0 +1,66 @@
+import heapq
+import threading
+from search_index import normalize, PrefixIndex
+
+
+class Suggestions(object):
+    """In-memory index of city names to suggest cities as the user types, the largest first."""
+
+    # Prefixes up to this length match many cities, so their results are memoized.
+    MEMO_PREFIX_LENGTH = 2
+
+    def __init__(self):
+        self._cities = []  # Each city is [geonameid, full name, population].
+        self._positions = {}  # geonameid -> position in _cities.
+        self._index = PrefixIndex()  # normalized full name -> position in _cities.
+        self._memo = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._cities)
+
+    def add(self, full_name, population, geonameid):
+        """Add a city, or update (and rename) the one with the same geonameid."""
+        key = normalize(full_name)
+        if not key:
+            return
+        with self._lock:
+            i = self._positions.get(geonameid)
+            if i is None:
+                i = self._positions[geonameid] = len(self._cities)
+                self._cities.append(None)
+                self._index.add(key, i)
+            else:
+                old_key = normalize(self._cities[i][1])
+                if old_key != key:
+                    self._index.remove(old_key, i)
+                    self._index.add(key, i)
+            self._cities[i] = [geonameid, full_name, population]
+            self._memo.clear()
+
+    def suggest(self, prefix, n=10):
+        """Return up to n cities whose name starts with the given prefix, the largest first."""
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        memoize = len(prefix) <= Suggestions.MEMO_PREFIX_LENGTH
+        if memoize and (prefix, n) in self._memo:
+            return self._memo[(prefix, n)]
+
+        with self._lock:
+            ranked = heapq.nlargest(
+                n, self._index.prefix(prefix), key=lambda i: self._cities[i][2]
+            )
+            result = [
+                {"name": full_name, "geonameid": geonameid, "population": population}
+                for geonameid, full_name, population in (self._cities[i] for i in ranked)
+            ]
+            if memoize:
+                self._memo[(prefix, n)] = result
+        return result
+
+
+def population_count(population):
+    """Convert a formatted population (e.g., "256,927") to an int; 0 if it's not a number."""
+    population = str(population).replace(",", "")
+    return int(population) if population.isdecimal() else 0
@@ -1,78 +1,122 @@
 from city import City
+from cache import TTLCache
+import metrics
+import csv
+import io
+import json
 import string
 import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
 
+# Output records and serialized xml of the fetched cities without their query,
+# by "geonameid@timestamp". Refreshing a city changes its timestamp, so outdated
+# entries are never used.
+_records = TTLCache(maxsize=5000)
+_xml_bodies = TTLCache(maxsize=5000, maxbytes=16 * 2**20, sizeof=len)
+metrics.register_cache("output_records", _records)
+metrics.register_cache("output_xml", _xml_bodies)
 
-def create_output_xml(city):
-    """Create a xml that contains the provided data."""
-    assert isinstance(city, City)
-
-    root = ET.Element("data", query=city.query)
-
-    fn = ET.Element("full_name")
-    fn.text = city.full_name
-    root.append(fn)
-
-    pop = ET.Element("population")
-    pop.text = city.population
-    root.append(pop)
 
-    wtr = ET.Element("weather")
-    wtr.text = "  |  ".join([f"{x}" for x in city.weather])
-    root.append(wtr)
+def _cache_key(city):
+    return f"{city.geonameid}@{city.timestamp}" if city._fetched else None
 
-    liv = ET.Element("city_livability")
-    liv.text = city.overall_livability
-    root.append(liv)
 
-    col = ET.Element("cost_of_living")
-    col.text = city.cost_of_living
-    root.append(col)
-
-    hou = ET.Element("housing")
-    hou.text = city.housing
-    root.append(hou)
+def create_output_record(city):
+    """Create a dict with the output fields for the provided data, in order."""
+    assert isinstance(city, City)
 
-    saf = ET.Element("safety")
-    saf.text = city.safety
-    root.append(saf)
+    key = _cache_key(city)
+    record = _records.get(key) if key else None
+    if record is None:
+        record = _create_output_record(city)
+        if key:
+            _records.set(key, record)
+    return {"query": city.query, **record}
 
-    sch = ET.Element("schools")
-    sch.text = city.schools
-    root.append(sch)
 
-    cmc = ET.Element("closest_major_cities")
+def _create_output_record(city):
+    """Create the output fields for the provided data, except the query."""
     if isinstance(city.closest_major_cities, str):
         # Check for the "headers city".
-        cmc.text = city.closest_major_cities
+        closest_major_cities = city.closest_major_cities
     else:
-        cmc.text = ", ".join(
+        closest_major_cities = ", ".join(
             [f'{c["name"]} ({c["distance"]:.0f}km)' for c in city.closest_major_cities]
         )
-    root.append(cmc)
 
-    cnmc = ET.Element("count_nearby_major_cities")
     if isinstance(city.nearby_major_cities, str):
         # Check for the "headers city".
-        cnmc.text = city.nearby_major_cities
+        count_nearby_major_cities = city.nearby_major_cities
     else:
-        cnmc.text = f"{len(city.nearby_major_cities)}"
-    root.append(cnmc)
+        count_nearby_major_cities = f"{len(city.nearby_major_cities)}"
 
-    lw = ET.Element("living_wage")
     if isinstance(city.living_wages, str):
-        lw.text = city.living_wages
+        living_wage = city.living_wages
     elif city.living_wages["metro"]:
-        lw.text = city.living_wages["metro"]["wages"]["2A1W0C"]
+        living_wage = city.living_wages["metro"]["wages"]["2A1W0C"]
     elif city.living_wages["county"]:
-        lw.text = city.living_wages["county"]["wages"]["2A1W0C"]
+        living_wage = city.living_wages["county"]["wages"]["2A1W0C"]
     elif city.living_wages["state"]:
-        lw.text = city.living_wages["state"]["wages"]["2A1W0C"]
+        living_wage = city.living_wages["state"]["wages"]["2A1W0C"]
     else:
-        lw.text = "N/A"
-    root.append(lw)
+        living_wage = "N/A"
+
+    return {
+        "full_name": city.full_name,
+        "population": city.population,
+        "weather": "  |  ".join([f"{x}" for x in city.weather]),
+        "city_livability": city.overall_livability,
+        "cost_of_living": city.cost_of_living,
+        "housing": city.housing,
+        "safety": city.safety,
+        "schools": city.schools,
+        "closest_major_cities": closest_major_cities,
+        "count_nearby_major_cities": count_nearby_major_cities,
+        "living_wage": living_wage,
+    }
+
+
+def create_output_xml(city):
+    """Create a xml that contains the provided data."""
+    assert isinstance(city, City)
+
+    key = _cache_key(city)
+    body = _xml_bodies.get(key) if key else None
+    if body is None:
+        root = ET.Element("data")
+        for field, value in create_output_record(city).items():
+            if field != "query":
+                ET.SubElement(root, field).text = value
+        body = ET.tostring(root)
+        if key:
+            _xml_bodies.set(key, body)
+
+    # Splice the query in, escaped and encoded like ElementTree would.
+    query = escape(
+        city.query, {'"': "&quot;", "\n": "&#10;", "\r": "&#13;", "\t": "&#09;"}
+    )
+    query = query.encode("ascii", "xmlcharrefreplace")
+    return b'<data query="' + query + b'"' + body[len(b"<data") :]
+
 
-    return ET.tostring(root)
+def create_output_json(city):
+    """Create a json object that contains the provided data."""
+    return json.dumps(create_output_record(city), ensure_ascii=False).encode()
+
+
+# Columns of the csv output, the same fields as the headers city.
+CSV_FIELDS = tuple(_create_output_record(City.create_headers_city()))
+
+
+def create_output_csv(city=None):
+    """Create a csv line that contains the provided data; the header line if there's no city."""
+    if city is None:
+        values = ("query",) + CSV_FIELDS
+    else:
+        values = create_output_record(city).values()
+    line = io.StringIO()
+    csv.writer(line).writerow(values)
+    return line.getvalue().encode()
 
 
 def validate_city_state(citystate):
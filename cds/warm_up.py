@@ -0,0 +1,104 @@
+import logging
+import os.path
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from city import City
+
+logger = logging.getLogger(__name__)
+
+
+def read_items(path):
+    """Return the geonameids or queries in a file, one per line; skips blank lines and # comments."""
+    with open(path, encoding="utf8") as file_in:
+        items = [line.strip() for line in file_in]
+    return [item for item in items if item and not item.startswith("#")]
+
+
+def warm_up(
+    app,
+    handler,
+    items,
+    *,
+    workers=4,
+    batch_size=20,
+    older_than=None,
+    checkpoint=None,
+    echo=print,
+):
+    """Fetch and store the data of the given cities (geonameids or queries).
+
+    Cities are fetched by a pool of workers and stored in batches, each with a
+    single commit. Cities stored with data newer than older_than are skipped.
+    If a checkpoint file is given, the finished items are appended to it after
+    each batch, and the items already in it are skipped, so an interrupted run
+    can be resumed. Cities with sources that failed are stored but count as
+    failed, so they aren't checkpointed and resuming fetches them again.
+    Returns the count of cities by outcome (fetched, fresh, not found, failed).
+    """
+    done = set()
+    if checkpoint and os.path.exists(checkpoint):
+        done.update(read_items(checkpoint))
+    todo = [item for item in dict.fromkeys(items) if item not in done]
+    echo(f"{len(todo)} cities to warm up ({len(done)} already done).")
+
+    # Queries for the same city are only fetched once.
+    claimed = set()
+    claimed_lock = threading.Lock()
+
+    def fetch(item):
+        with app.app_context():
+            geonameid = item if item.isdecimal() else handler.resolve_query(item)
+            if not geonameid:
+                return "not found", None
+            with claimed_lock:
+                if geonameid in claimed:
+                    return "duplicate", None
+                claimed.add(geonameid)
+            if older_than is not None and handler.is_fresh(
+                geonameid, older_than=older_than
+            ):
+                return "fresh", None
+        data = City(geonameid)
+        data.fetch_data()
+        if data.failed_sources:
+            # Stored anyway, but not checkpointed so it's fetched again when resuming.
+            logger.warning(f"Sources {data.failed_sources} failed for {item!r}.")
+            return "failed", (geonameid, data)
+        return "fetched", (geonameid, data)
+
+    counts = Counter()
+    batch, finished = [], []
+
+    def store_batch():
+        if batch:
+            handler.store_many(batch)
+        if checkpoint:
+            with open(checkpoint, "a", encoding="utf8") as file_out:
+                file_out.writelines(f"{item}\n" for item in finished)
+        batch.clear()
+        finished.clear()
+        echo(f"{sum(counts.values())}/{len(todo)} cities: {dict(counts)}")
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="warm-up") as pool:
+        futures = {pool.submit(fetch, item): item for item in todo}
+        for future in as_completed(futures):
+            item = futures[future]
+            try:
+                outcome, city = future.result()
+            except Exception:
+                # Not added to the checkpoint, so it's retried when resuming.
+                logger.exception(f"Couldn't warm up {item!r}.")
+                counts["failed"] += 1
+                continue
+            counts[outcome] += 1
+            if city:
+                batch.append(city)
+            if outcome != "failed":
+                finished.append(item)
+            if len(batch) >= batch_size or len(finished) >= batch_size:
+                with app.app_context():
+                    store_batch()
+        with app.app_context():
+            store_batch()
+    return counts
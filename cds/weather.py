@@ -1,14 +1,37 @@
-from datetime import datetime
+import os.path
+from datetime import datetime, timedelta
+from os import getenv
 from meteostat import Point, Daily
+from cache import TTLCache
+import http_client
+import metrics
 
+# Keep meteostat's own on-disk cache of station data for longer than its default
+# (1 day), a past year's data barely changes.
+if getenv("CDS_METEOSTAT_CACHE_DIR"):
+    Daily.cache_dir = getenv("CDS_METEOSTAT_CACHE_DIR")
+Daily.max_age = int(getenv("CDS_METEOSTAT_MAX_AGE", f"{30 * 24 * 60 * 60}"))
 
-def get_year_round_weather(coordinates, year):
-    assert isinstance(coordinates, tuple)
-    assert len(coordinates) == 2
-    assert isinstance(coordinates[0], float)
-    assert isinstance(coordinates[1], float)
-    assert isinstance(year, int)
+# Coordinates are rounded to this many decimals (~11km) before computing the
+# weather, so nearby cities share the same summary.
+COORDINATES_PRECISION = 1
 
+# "lat,lng,year" -> (lowest, low, avg, high, highest) temperatures.
+_cache_dir = getenv("CDS_CACHE_DIR", "")
+_summaries = TTLCache(
+    maxsize=20000,
+    ttl=timedelta(days=90),
+    path=os.path.join(_cache_dir, "weather.json") if _cache_dir else None,
+)
+metrics.register_cache("weather", _summaries)
+
+
+def _summary_key(coordinates, year):
+    lat, lng = (round(c, COORDINATES_PRECISION) for c in coordinates)
+    return f"{lat},{lng},{year}"
+
+
+def _compute_year_round_weather(coordinates, year):
     # Define the date range we're analyzing.
     weather_start = datetime(year, 1, 1)
     weather_end = datetime(year, 12, 31)
@@ -22,11 +45,11 @@ def get_year_round_weather(coordinates, year):
         data = data.interpolate()
         data = data.fetch()
         data.dropna()
-        lowest = data["tmin"].min()
-        low = data["tmin"].median()
-        avg = data["tavg"].median()
-        high = data["tmax"].median()
-        highest = data["tmax"].max()
+        lowest = float(data["tmin"].min())
+        low = float(data["tmin"].median())
+        avg = float(data["tavg"].median())
+        high = float(data["tmax"].median())
+        highest = float(data["tmax"].max())
     except KeyError:
         lowest = "N/A"
         low = "N/A"
@@ -35,3 +58,33 @@ def get_year_round_weather(coordinates, year):
         highest = "N/A"
 
     return lowest, low, avg, high, highest
+
+
+def get_year_round_weather(coordinates, year):
+    assert isinstance(coordinates, tuple)
+    assert len(coordinates) == 2
+    assert isinstance(coordinates[0], float)
+    assert isinstance(coordinates[1], float)
+    assert isinstance(year, int)
+
+    return get_year_round_weather_many([coordinates], year)[0]
+
+
+def get_year_round_weather_many(coordinates_list, year):
+    """Return the weather summaries for all given coordinates, computing each rounded location only once."""
+    assert isinstance(year, int)
+
+    keys = [_summary_key(coordinates, year) for coordinates in coordinates_list]
+    summaries = {}
+    for key in keys:
+        if key in summaries:
+            continue
+        summary = _summaries.get(key)
+        if summary is None:
+            lat, lng, _ = key.split(",")
+            # Meteostat downloads its data without our http client, so it has its own circuit.
+            with http_client.circuit("meteostat"):
+                summary = _compute_year_round_weather((float(lat), float(lng)), year)
+            _summaries.set(key, summary)
+        summaries[key] = tuple(summary)
+    return [summaries[key] for key in keys]
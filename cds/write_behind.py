@@ -0,0 +1,188 @@
+import atexit
+import logging
+import threading
+import time
+from sqlalchemy.exc import OperationalError
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_WRITES = metrics.Counter(
+    "cds_write_behind_total",
+    "Cities written by the background writer, by outcome.",
+    ["outcome"],
+)
+
+
+class WriteBehind(object):
+    """Store freshly fetched cities in the DB from a background thread, in batches.
+
+    Requests get their city as soon as it's fetched instead of waiting for its
+    commit. The cities waiting to be written are kept here so reads (of the city
+    and of its image) still find them, and a batch is written when it has
+    batch_size cities or its first city waited for max_delay seconds.
+    Transient DB errors (e.g., lock timeouts, deadlocks or lost connections) are
+    retried with exponential backoff.
+
+    Other workers only see a city once it's written, so for up to max_delay
+    seconds they may fetch the same city again. A city that still can't be
+    written is dropped from the handler's cache, so it's fetched again.
+    """
+
+    def __init__(
+        self,
+        app,
+        handler,
+        *,
+        batch_size=50,
+        max_delay=1.0,
+        max_pending=1000,
+        retries=5,
+        retry_delay=0.5,
+    ):
+        self._app = app
+        self._handler = handler
+        self._batch_size = batch_size
+        self._max_delay = max_delay
+        self._max_pending = max_pending
+        self._retries = retries
+        self._retry_delay = retry_delay
+        # geonameid -> (City, image) waiting to be written, in the order they arrived.
+        self._pending = {}
+        self._first_pending = None  # time.monotonic() when the oldest pending city arrived.
+        # The batch being written, still visible to reads until it's committed.
+        self._writing = {}
+        self._flushing = 0  # Number of flush() calls waiting, batches aren't delayed while > 0.
+        self._cond = threading.Condition()
+        self._thread = None
+        metrics.register_collector(self._collect)
+
+    def add(self, geonameid, data, image):
+        """Queue a city and its image to be written; returns False if the queue is full."""
+        key = str(geonameid)
+        with self._cond:
+            if key not in self._pending and len(self._pending) >= self._max_pending:
+                return False
+            if not self._pending:
+                self._first_pending = time.monotonic()
+            # A newer fetch of the same city replaces the pending one.
+            self._pending.pop(key, None)
+            self._pending[key] = (data, image)
+            self._cond.notify_all()
+            # Start the thread on first use, since gunicorn forks the workers after importing the app.
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="city-writer", daemon=True
+                )
+                self._thread.start()
+                atexit.register(self.flush, timeout=30)
+        return True
+
+    def get(self, geonameid):
+        """Return the pending City with the given geonameid, None if there isn't one."""
+        key = str(geonameid)
+        with self._cond:
+            pending = self._pending.get(key) or self._writing.get(key)
+        return pending[0] if pending else None
+
+    def get_image(self, digest):
+        """Return (content type, content) of a pending image, None if there isn't one."""
+        with self._cond:
+            cities = list(self._pending.values()) + list(self._writing.values())
+        for _, image in cities:
+            if image and image[0] == digest:
+                return image[1], image[2]
+        return None
+
+    def __len__(self):
+        return len(self._pending) + len(self._writing)
+
+    def flush(self, timeout=None):
+        """Wait until every pending city is written; returns whether they were."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._flushing += 1
+            self._cond.notify_all()
+            try:
+                while self._pending or self._writing:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        return False
+                    self._cond.wait(remaining)
+            finally:
+                self._flushing -= 1
+        return True
+
+    def _next_batch(self):
+        """Wait for a full batch, or for the oldest pending city to wait max_delay."""
+        with self._cond:
+            while True:
+                if self._pending:
+                    waited = time.monotonic() - self._first_pending
+                    if (
+                        len(self._pending) >= self._batch_size
+                        or waited >= self._max_delay
+                        or self._flushing
+                    ):
+                        break
+                    self._cond.wait(self._max_delay - waited)
+                else:
+                    self._cond.wait()
+            keys = list(self._pending)[: self._batch_size]
+            self._writing = {key: self._pending.pop(key) for key in keys}
+            self._first_pending = time.monotonic() if self._pending else None
+            return [(key, data, image) for key, (data, image) in self._writing.items()]
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                with self._app.app_context():
+                    self._write(batch)
+            except Exception:
+                logger.exception(f"Couldn't write {len(batch)} cities.")
+                for city in batch:
+                    self._handler.discard(city[0])
+            finally:
+                with self._cond:
+                    self._writing = {}
+                    self._cond.notify_all()
+
+    def _write(self, batch):
+        """Write a batch, retrying transient errors; a batch that still fails is written one city at a time."""
+        for attempt in range(self._retries + 1):
+            try:
+                self._handler.write_many(batch)
+                _WRITES.inc("written", amount=len(batch))
+                return
+            except OperationalError:
+                self._handler.rollback()
+                if attempt == self._retries:
+                    _WRITES.inc("failed", amount=len(batch))
+                    raise
+                _WRITES.inc("retried", amount=len(batch))
+                logger.warning(f"Retrying the write of {len(batch)} cities.", exc_info=True)
+                time.sleep(self._retry_delay * 2**attempt)
+            except Exception:
+                self._handler.rollback()
+                if len(batch) == 1:
+                    _WRITES.inc("failed")
+                    raise
+                # Don't lose the whole batch to a single bad city.
+                for city in batch:
+                    try:
+                        self._write([city])
+                    except Exception:
+                        logger.exception(f"Couldn't write city {city[0]}.")
+                        self._handler.discard(city[0])
+                return
+
+    def _collect(self):
+        return [
+            (
+                "cds_write_behind_pending",
+                "gauge",
+                "Cities waiting to be written by the background writer.",
+                [({}, len(self))],
+            )
+        ]
@@ -0,0 +1,7 @@
+import os.path
+import sys
+
+# The app's modules import each other by name from the cds directory.
+sys.path.insert(
+    0, os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "cds")
+)
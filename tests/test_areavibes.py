@@ -0,0 +1,70 @@
+import os.path
+import pytest
+from areavibes import parse_scores, _LABELS
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.realpath(__file__)), "fixtures")
+
+# A synthetic page written after the markup of areavibes' livability pages (a
+# label in an <em>, then its score in the next element), not a download: it
+# tests the parser against that markup, not that the markup is still the site's.
+SCORES = {
+    "overall_livability": "84",
+    "cost_of_living": "F",
+    "safety": "A",
+    "housing": "D-",
+    "schools": "A+",
+}
+
+
+def _parse_scores_slicing(html):
+    """Previous parser that slices the page after each label, the reference for parse_scores."""
+    scores = {}
+    for label, attr in _LABELS.items():
+        flag = f"<em>{label}</em>"
+        html = html[html.find(flag) + len(flag) + 1 :]
+        start = html.find(">") + 1
+        end = html.find("<")
+        score = html[start:end]
+        if score:
+            scores[attr] = score
+    return scores
+
+
+@pytest.fixture(scope="module")
+def page():
+    with open(os.path.join(FIXTURES_DIR, "areavibes_livability_synthetic.html")) as file_in:
+        return file_in.read()
+
+
+def test_parse_scores(page):
+    assert parse_scores(page) == SCORES
+
+
+def test_same_scores_as_slicing(page):
+    assert parse_scores(page) == _parse_scores_slicing(page)
+
+
+def test_missing_label(page):
+    page = page.replace("<em>Housing</em>", "<em>Homes</em>")
+    expected = {k: v for k, v in SCORES.items() if k != "housing"}
+    assert parse_scores(page) == expected
+
+
+def test_empty_score(page):
+    page = page.replace(
+        '<em>Crime</em><i class="grade">A</i>', '<em>Crime</em><i class="grade"></i>'
+    )
+    expected = {k: v for k, v in SCORES.items() if k != "safety"}
+    assert parse_scores(page) == expected
+
+
+def test_no_scores():
+    assert parse_scores("<html><body>Not Found</body></html>") == {}
+    assert parse_scores("") == {}
+
+
+def test_large_page(page):
+    # Real pages are a few hundred KB, mostly markup around the scores.
+    padding = "<li><a href='/'>more links</a></li>\n" * 10000
+    large_page = page.replace("<section", padding + "<section")
+    assert parse_scores(large_page) == SCORES
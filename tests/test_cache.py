@@ -0,0 +1,97 @@
+import pytest
+import cache
+from cache import TTLCache
+
+
+class Clock(object):
+    """Stands in for the time module in cache, so entries expire without waiting."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(cache, "time", clock)
+    return clock
+
+
+def test_entries_expire(clock):
+    c = TTLCache(ttl=10)
+    c.set("a", 1)
+    clock.now += 9
+    assert c.get("a") == 1
+    clock.now += 2
+    assert c.get("a") is None
+    assert len(c) == 0
+    assert c.stats()["misses"] == 1
+
+
+def test_entry_ttl_overrides_the_cache_ttl(clock):
+    c = TTLCache(ttl=10)
+    c.set("short", 1, ttl=1)
+    c.set("default", 3)
+    clock.now += 5
+    assert c.get("short") is None
+    assert c.get("default") == 3
+    clock.now += 6
+    assert c.get("default") is None
+
+
+def test_no_ttl_never_expires(clock):
+    c = TTLCache()
+    c.set("a", 1)
+    clock.now += 10**9
+    assert c.get("a") == 1
+
+
+def test_maxsize_evicts_least_recently_used():
+    c = TTLCache(maxsize=2)
+    c.set("a", 1)
+    c.set("b", 2)
+    c.get("a")
+    c.set("c", 3)
+    assert c.get("b") is None
+    assert c.get("a") == 1
+    assert c.get("c") == 3
+    assert c.stats()["evictions"] == 1
+
+
+def test_maxbytes_evicts_until_under_limit():
+    c = TTLCache(maxbytes=10, sizeof=len)
+    c.set("a", "xxxx")
+    c.set("b", "xxxx")
+    c.get("a")
+    c.set("c", "xxxx")
+    assert c.get("b") is None
+    assert c.currbytes == 8
+    c.set("d", "x" * 9)
+    assert len(c) == 1
+    assert c.get("d") == "x" * 9
+    assert c.currbytes == 9
+
+
+def test_maxbytes_counts_replaced_and_removed_entries():
+    c = TTLCache(maxbytes=10, sizeof=len)
+    c.set("a", "xxxx")
+    c.set("a", "xxxxxx")
+    assert c.currbytes == 6
+    c.pop("a")
+    assert c.currbytes == 0
+    c.set("b", "xxxx")
+    c.clear()
+    assert c.currbytes == 0
+
+
+def test_expired_entries_free_their_bytes(clock):
+    c = TTLCache(ttl=10, maxbytes=10, sizeof=len)
+    c.set("a", "xxxxxx")
+    clock.now += 11
+    assert c.get("a") is None
+    assert c.currbytes == 0
+    c.set("b", "xxxxxx")
+    assert c.stats()["evictions"] == 0
@@ -0,0 +1,107 @@
+import time
+import pytest
+import utils  # noqa: F401 (imported before city, which imports it back)
+from city import City
+
+
+def _weather(city):
+    city.weather_year = 2025
+    city.weather = (1, 2, 3, 4, 5)
+
+
+def _living_wages(city):
+    city.living_wages = {"metro": None, "county": None, "state": {"name": "CA"}}
+
+
+def _nearby(city):
+    city.nearby_major_cities = ["Los Angeles"]
+    city.closest_major_cities = ["Los Angeles"]
+
+
+def _image(city):
+    city.img = "digest"
+
+
+def _areavibes(city):
+    city.overall_livability = "84"
+    city.cost_of_living = "F"
+    city.housing = "D-"
+    city.schools = "A+"
+    city.safety = "A"
+
+
+def _fails(city):
+    # Partial data before failing must not end up in the city.
+    city.overall_livability = "partial"
+    raise ConnectionError("Upstream is down.")
+
+
+def _hangs(city):
+    city.img = "late"
+    time.sleep(1)
+
+
+@pytest.fixture
+def sources(monkeypatch):
+    """Replace the data sources with instant ones, tests then replace some with failing ones."""
+    sources = {
+        "_fetch_areavibes": _areavibes,
+        "_fetch_city_image": _image,
+        "_fetch_weather": _weather,
+        "_fetch_living_wages": _living_wages,
+        "_find_nearby_major_cities": _nearby,
+    }
+    for name, source in sources.items():
+        monkeypatch.setattr(City, name, source)
+    return lambda name, source: monkeypatch.setattr(City, name, source)
+
+
+def _fetch_sources():
+    city = City("5359777", "Irvine, CA, US")
+    city.failed_sources = []
+    city._fetch_sources_concurrently()
+    return city
+
+
+def test_all_sources(sources):
+    city = _fetch_sources()
+    assert city.failed_sources == []
+    assert city.overall_livability == "84"
+    assert city.img == "digest"
+    assert city.weather == (1, 2, 3, 4, 5)
+    assert city.living_wages["state"] == {"name": "CA"}
+    assert city.nearby_major_cities == ["Los Angeles"]
+
+
+def test_failed_source_falls_back_to_defaults(sources):
+    sources("_fetch_areavibes", _fails)
+    city = _fetch_sources()
+    assert city.failed_sources == ["areavibes"]
+    for attr in ("overall_livability", "cost_of_living", "housing", "schools", "safety"):
+        assert getattr(city, attr) == "N/A"
+    # The other sources are kept.
+    assert city.img == "digest"
+    assert city.weather == (1, 2, 3, 4, 5)
+
+
+def test_timed_out_source_falls_back_to_defaults(sources, monkeypatch):
+    sources("_fetch_city_image", _hangs)
+    monkeypatch.setitem(City._SOURCE_TIMEOUTS, "_fetch_city_image", 0.1)
+    start = time.monotonic()
+    city = _fetch_sources()
+    assert time.monotonic() - start < 0.9
+    assert city.failed_sources == ["city_image"]
+    assert city.img == "N/A"
+    assert city.overall_livability == "84"
+
+
+def test_several_failed_sources(sources):
+    sources("_fetch_weather", _fails)
+    sources("_fetch_living_wages", _fails)
+    sources("_find_nearby_major_cities", _fails)
+    city = _fetch_sources()
+    assert sorted(city.failed_sources) == ["living_wages", "nearby_major_cities", "weather"]
+    assert city.weather == ("N/A",) * 5
+    assert city.living_wages == "N/A"
+    assert city.nearby_major_cities == [] and city.closest_major_cities == []
+    assert city.overall_livability == "84"
@@ -0,0 +1,67 @@
+import contextlib
+import threading
+from datetime import timedelta
+from refresher import RefreshQueue
+
+
+class FakeApp(object):
+    def app_context(self):
+        return contextlib.nullcontext()
+
+
+class FakeHandler(object):
+    """Records the refreshed cities; refreshing "bad" raises."""
+
+    def __init__(self, expected):
+        self.refreshed = []
+        self.done = threading.Event()
+        self._expected = expected
+
+    def refresh_city(self, geonameid, *, older_than):
+        self.refreshed.append(geonameid)
+        if len(self.refreshed) == self._expected:
+            self.done.set()
+        if geonameid == "bad":
+            raise ConnectionError("Upstream is down.")
+
+
+def _queue(handler, **kwargs):
+    return RefreshQueue(
+        FakeApp(), handler, older_than=timedelta(days=1), min_interval=0, **kwargs
+    )
+
+
+def test_most_requested_first():
+    handler = FakeHandler(expected=3)
+    queue = _queue(handler)
+    # Hold the refresher thread until every city is queued.
+    with queue._cond:
+        for geonameid in ["1", "2", "2", "3", "3", "3"]:
+            assert queue.enqueue(geonameid)
+        assert len(queue) == 3
+    assert handler.done.wait(5)
+    assert handler.refreshed == ["3", "2", "1"]
+
+
+def test_failed_refresh_keeps_going():
+    handler = FakeHandler(expected=2)
+    queue = _queue(handler)
+    with queue._cond:
+        queue.enqueue("bad")
+        queue.enqueue("bad")
+        queue.enqueue("1")
+    assert handler.done.wait(5)
+    assert handler.refreshed == ["bad", "1"]
+
+
+def test_full_queue_rejects_new_cities():
+    handler = FakeHandler(expected=2)
+    queue = _queue(handler, max_queued=2)
+    with queue._cond:
+        assert queue.enqueue("1")
+        assert queue.enqueue("2")
+        assert not queue.enqueue("3")
+        # Cities already queued can still be requested again.
+        assert queue.enqueue("2")
+    assert handler.done.wait(5)
+    assert handler.refreshed == ["2", "1"]
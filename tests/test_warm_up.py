@@ -0,0 +1,103 @@
+import contextlib
+import pytest
+import utils  # noqa: F401 (imported before city, which imports it back)
+import warm_up as warm_up_module
+from warm_up import read_items, warm_up
+
+
+class FakeApp(object):
+    def app_context(self):
+        return contextlib.nullcontext()
+
+
+class FakeHandler(object):
+    def __init__(self, queries=None, fresh=()):
+        self.queries = queries or {}
+        self.fresh = set(fresh)
+        self.stored = []
+
+    def resolve_query(self, query):
+        return self.queries.get(query)
+
+    def is_fresh(self, geonameid, *, older_than):
+        return geonameid in self.fresh
+
+    def store_many(self, cities):
+        self.stored.extend(geonameid for geonameid, _ in cities)
+
+
+class FakeCity(object):
+    """Fetches instantly; the geonameids in errors raise and the ones in
+    incomplete have a failed source."""
+
+    errors = set()
+    incomplete = set()
+    fetched = []
+
+    def __init__(self, geonameid):
+        self.geonameid = geonameid
+        self.failed_sources = []
+
+    def fetch_data(self):
+        FakeCity.fetched.append(self.geonameid)
+        if self.geonameid in FakeCity.errors:
+            raise ConnectionError("Upstream is down.")
+        if self.geonameid in FakeCity.incomplete:
+            self.failed_sources = ["weather"]
+
+
+@pytest.fixture(autouse=True)
+def fake_city(monkeypatch):
+    monkeypatch.setattr(warm_up_module, "City", FakeCity)
+    FakeCity.errors, FakeCity.incomplete, FakeCity.fetched = set(), set(), []
+
+
+def _warm_up(handler, items, checkpoint, **kwargs):
+    return warm_up(
+        FakeApp(), handler, items, checkpoint=checkpoint, echo=lambda _: None, **kwargs
+    )
+
+
+def test_counts_and_stores():
+    handler = FakeHandler(queries={"Irvine, CA": "1", "irvine": "1"}, fresh={"3"})
+    counts = _warm_up(
+        handler,
+        ["Irvine, CA", "irvine", "2", "3", "Nowhere"],
+        None,
+        older_than=object(),
+    )
+    assert counts == {"fetched": 2, "duplicate": 1, "fresh": 1, "not found": 1}
+    assert sorted(handler.stored) == ["1", "2"]
+
+
+def test_resume_from_checkpoint(tmp_path):
+    checkpoint = str(tmp_path / "cities.done")
+    items = [str(i) for i in range(1, 8)]
+    FakeCity.errors = {"2"}
+    FakeCity.incomplete = {"5"}
+
+    handler = FakeHandler()
+    counts = _warm_up(handler, items, checkpoint, batch_size=2)
+    assert counts == {"fetched": 5, "failed": 2}
+    # The incomplete city is stored anyway, the one that raised isn't.
+    assert sorted(handler.stored) == ["1", "3", "4", "5", "6", "7"]
+    assert sorted(read_items(checkpoint)) == ["1", "3", "4", "6", "7"]
+
+    # Resuming only fetches the cities that failed.
+    FakeCity.errors, FakeCity.incomplete, FakeCity.fetched = set(), set(), []
+    handler = FakeHandler()
+    counts = _warm_up(handler, items, checkpoint, batch_size=2)
+    assert counts == {"fetched": 2}
+    assert sorted(FakeCity.fetched) == ["2", "5"]
+    assert sorted(read_items(checkpoint)) == items
+
+    # And then there's nothing left to do.
+    FakeCity.fetched = []
+    assert _warm_up(FakeHandler(), items, checkpoint) == {}
+    assert FakeCity.fetched == []
+
+
+def test_read_items_skips_blanks_and_comments(tmp_path):
+    path = tmp_path / "cities.txt"
+    path.write_text("# Cities to warm up\n5359777\n\n  Irvine, CA  \n#3448439\n")
+    assert read_items(str(path)) == ["5359777", "Irvine, CA"]
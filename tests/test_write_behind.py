@@ -0,0 +1,114 @@
+import contextlib
+import threading
+from sqlalchemy.exc import OperationalError
+from write_behind import WriteBehind
+
+
+class FakeApp(object):
+    def app_context(self):
+        return contextlib.nullcontext()
+
+
+class FakeHandler(object):
+    """Records the batches written; cities named "bad" can't be written, and the
+    first `failures` writes fail with a transient error."""
+
+    def __init__(self, failures=0):
+        self.batches = []
+        self.discarded = []
+        self.rollbacks = 0
+        self.failures = failures
+        self.lock = threading.Lock()
+
+    def write_many(self, batch):
+        with self.lock:
+            if self.failures:
+                self.failures -= 1
+                raise OperationalError("INSERT", {}, Exception("Lock wait timeout"))
+            if any(data == "bad" for _, data, _ in batch):
+                raise ValueError("Can't store a bad city.")
+            self.batches.append([key for key, _, _ in batch])
+
+    def rollback(self):
+        self.rollbacks += 1
+
+    def discard(self, key):
+        self.discarded.append(key)
+
+    @property
+    def written(self):
+        return sorted(key for batch in self.batches for key in batch)
+
+
+def _writer(handler, **kwargs):
+    kwargs.setdefault("max_delay", 60)
+    kwargs.setdefault("retry_delay", 0)
+    return WriteBehind(FakeApp(), handler, **kwargs)
+
+
+def test_writes_in_batches():
+    handler = FakeHandler()
+    writer = _writer(handler, batch_size=3)
+    for i in range(7):
+        writer.add(i, "city", None)
+    assert writer.flush(timeout=5)
+    assert handler.written == [str(i) for i in range(7)]
+    assert all(len(batch) <= 3 for batch in handler.batches)
+    assert len(writer) == 0
+
+
+def test_pending_cities_are_readable():
+    handler = FakeHandler()
+    writer = _writer(handler)
+    writer.add(1, "city", ("digest", "image/png", b"png"))
+    assert writer.get(1) == "city"
+    assert writer.get_image("digest") == ("image/png", b"png")
+    assert writer.flush(timeout=5)
+    assert writer.get(1) is None
+    assert writer.get_image("digest") is None
+
+
+def test_failed_batch_falls_back_to_one_by_one():
+    handler = FakeHandler()
+    writer = _writer(handler, batch_size=10)
+    for i, data in enumerate(["city", "bad", "city", "city"]):
+        writer.add(i, data, None)
+    assert writer.flush(timeout=5)
+    # Only the bad city is lost, and it's dropped from the cache to be fetched again.
+    assert handler.written == ["0", "2", "3"]
+    assert handler.discarded == ["1"]
+    assert handler.rollbacks >= 2
+
+
+def test_transient_errors_are_retried():
+    handler = FakeHandler(failures=2)
+    writer = _writer(handler, batch_size=10)
+    for i in range(3):
+        writer.add(i, "city", None)
+    assert writer.flush(timeout=5)
+    assert handler.written == ["0", "1", "2"]
+    assert handler.discarded == []
+
+
+def test_persistent_transient_errors_discard_the_batch():
+    handler = FakeHandler(failures=100)
+    writer = _writer(handler, batch_size=10, retries=2)
+    for i in range(3):
+        writer.add(i, "city", None)
+    assert writer.flush(timeout=5)
+    assert handler.written == []
+    assert sorted(handler.discarded) == ["0", "1", "2"]
+
+
+def test_full_queue_rejects_new_cities():
+    handler = FakeHandler()
+    writer = _writer(handler, max_pending=2)
+    # Hold the writer thread, so nothing leaves the queue.
+    with writer._cond:
+        assert writer.add(1, "city", None)
+        assert writer.add(2, "city", None)
+        assert not writer.add(3, "city", None)
+        # A city already queued is replaced.
+        assert writer.add(2, "newer", None)
+    assert writer.get(2) == "newer"
+    assert writer.flush(timeout=5)